@@ -0,0 +1,419 @@
+"""
+Архив старых замеров: замеры старше ARCHIVE_AFTER_DAYS переносятся из glucose_readings
+в сжатые колоночные файлы NumPy (.npz), по одному на клиента
+Накопительная статистика, гистограмма и дневная активность остаются в базе и учитывают архив;
+выборки замеров и агрегаты по дням объединяют базу и архив
+numpy импортируется при первом обращении к архиву, а не при запуске бота
+"""
+import logging
+import os
+import tempfile
+import time
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, insert, delete, func
+
+from config import ARCHIVE_DIR, ARCHIVE_AFTER_DAYS
+from database import engine, GlucoseReading, UserPeriodStats
+from queries import (
+    TIME_IN_RANGE, TIME_IN_TARGET, period_stats_upsert, period_stats_params,
+    histogram_upsert, histogram_params, daily_activity_upsert, daily_activity_params, reading_days_query
+)
+from renderer import PERIOD_CODES
+
+logger = logging.getLogger(__name__)
+
+# Колонки архива: время (datetime64[us]), значение, код периода, названия периодов по кодам
+# и граница: в архиве только замеры раньше until
+Archive = namedtuple('Archive', 'timestamps values periods period_names until')
+ArchivedReading = namedtuple('ArchivedReading', 'timestamp value period')
+
+# Сколько замеров удалять из базы одним запросом (ограничение числа параметров SQLite)
+DELETE_CHUNK = 5000
+
+
+def archive_path(user_id: int, directory: str = ARCHIVE_DIR) -> str:
+    return os.path.join(directory, f"{user_id}.npz")
+
+
+def has_archive(user_id: int, directory: str = ARCHIVE_DIR) -> bool:
+    return os.path.exists(archive_path(user_id, directory))
+
+
+def archived_users(directory: str = ARCHIVE_DIR) -> list:
+    """VK ID клиентов, у которых есть архив"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name[:-4]) for name in os.listdir(directory)
+                  if name.endswith('.npz') and name[:-4].isdigit())
+
+
+def load_archive(user_id: int, directory: str = ARCHIVE_DIR):
+    """Архив клиента или None"""
+    import numpy as np
+
+    path = archive_path(user_id, directory)
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return Archive(data['timestamps'], data['values'], data['periods'],
+                       tuple(data['period_names'].tolist()), data['until'][()].item())
+
+
+def archive_until(user_id: int, directory: str = ARCHIVE_DIR):
+    """Граница архива клиента (читается только она, без распаковки замеров) или None"""
+    import numpy as np
+
+    path = archive_path(user_id, directory)
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return data['until'][()].item()
+
+
+def _write_archive(user_id: int, archive: Archive, directory: str):
+    """Записать архив атомарно: временный файл в той же папке и переименование"""
+    import numpy as np
+
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(prefix=f'.{user_id}_', suffix='.npz', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            np.savez_compressed(
+                file,
+                timestamps=archive.timestamps,
+                values=archive.values,
+                periods=archive.periods,
+                period_names=np.array(archive.period_names, dtype=str),
+                until=np.array(archive.until, dtype='datetime64[us]')
+            )
+        os.replace(tmp_path, archive_path(user_id, directory))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _merge(archive, rows, until: datetime) -> Archive:
+    """Добавить замеры (timestamp, value, period) к архиву; точные повторы отбрасываются"""
+    import numpy as np
+
+    names = list(archive.period_names) if archive else []
+    codes = {name: code for code, name in enumerate(names)}
+    for row in rows:
+        if row.period not in codes:
+            codes[row.period] = len(names)
+            names.append(row.period)
+
+    timestamps = np.array([row.timestamp for row in rows], dtype='datetime64[us]')
+    values = np.fromiter((row.value for row in rows), dtype=np.float64, count=len(rows))
+    periods = np.fromiter((codes[row.period] for row in rows), dtype=np.int16, count=len(rows))
+    if archive is not None:
+        timestamps = np.concatenate([archive.timestamps, timestamps])
+        values = np.concatenate([archive.values, values])
+        periods = np.concatenate([archive.periods.astype(np.int16), periods])
+        until = max(until, archive.until)
+
+    # Повтор после сбоя между записью архива и удалением из базы не задваивает замеры
+    order = np.lexsort((periods, values, timestamps))
+    timestamps, values, periods = timestamps[order], values[order], periods[order]
+    unique = np.ones(len(order), dtype=bool)
+    unique[1:] = (timestamps[1:] != timestamps[:-1]) | (values[1:] != values[:-1]) | (periods[1:] != periods[:-1])
+    return Archive(timestamps[unique], values[unique], periods[unique], tuple(names), until)
+
+
+def archive_cutoff(older_than_days: int = ARCHIVE_AFTER_DAYS) -> datetime:
+    """Граница архивации — полночь: дни архива и базы не пересекаются (для дневной активности)"""
+    return datetime.combine(date.today() - timedelta(days=older_than_days), datetime.min.time())
+
+
+def archive_user(user_id: int, cutoff: datetime, directory: str = ARCHIVE_DIR) -> int:
+    """
+    Перенести замеры клиента раньше cutoff в архив
+    Сначала записывается архив, затем из базы удаляются ровно перенесённые строки (по id)
+    :return: число перенесённых замеров
+    """
+    r = GlucoseReading
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select(r.id, r.timestamp, r.value, r.period)
+            .where(r.user_id == user_id, r.timestamp < cutoff)
+            .order_by(r.timestamp)
+        ).all()
+    if not rows:
+        return 0
+
+    _write_archive(user_id, _merge(load_archive(user_id, directory), rows, cutoff), directory)
+
+    ids = [row.id for row in rows]
+    with engine.begin() as connection:
+        for start in range(0, len(ids), DELETE_CHUNK):
+            connection.execute(delete(r).where(r.id.in_(ids[start:start + DELETE_CHUNK])))
+    return len(rows)
+
+
+def archive_readings(older_than_days: int = ARCHIVE_AFTER_DAYS, directory: str = ARCHIVE_DIR) -> int:
+    """Перенести в архив замеры всех клиентов старше older_than_days дней; :return: число замеров"""
+    cutoff = archive_cutoff(older_than_days)
+    started = time.perf_counter()
+    # Клиенты со старыми замерами — по накопительной статистике, без просмотра замеров
+    with engine.connect() as connection:
+        user_ids = connection.scalars(
+            select(UserPeriodStats.user_id)
+            .group_by(UserPeriodStats.user_id)
+            .having(func.min(UserPeriodStats.first_timestamp) < cutoff)
+        ).all()
+
+    total = 0
+    for user_id in user_ids:
+        moved = archive_user(user_id, cutoff, directory)
+        if moved:
+            logger.info(f"Пользователь {user_id}: в архив перенесено {moved} замеров")
+        total += moved
+
+    logger.info(f"Архивация до {cutoff:%Y-%m-%d}: {total} замеров за {time.perf_counter() - started:.1f} с")
+    return total
+
+
+def restore_user(user_id: int, directory: str = ARCHIVE_DIR) -> int:
+    """Вернуть замеры клиента из архива в базу и удалить архив; :return: число замеров"""
+    archive = load_archive(user_id, directory)
+    if archive is None:
+        return 0
+
+    readings = archived_readings(user_id, archive=archive)
+    with engine.begin() as connection:
+        for start in range(0, len(readings), DELETE_CHUNK):
+            connection.execute(insert(GlucoseReading), [
+                {'user_id': user_id, 'timestamp': row.timestamp, 'value': row.value, 'period': row.period}
+                for row in readings[start:start + DELETE_CHUNK]
+            ])
+    os.remove(archive_path(user_id, directory))
+    logger.info(f"Пользователь {user_id}: из архива возвращено {len(readings)} замеров")
+    return len(readings)
+
+
+# ============= ЧТЕНИЕ =============
+def archived_readings(user_id: int, since: datetime = None, archive: Archive = None,
+                      directory: str = ARCHIVE_DIR) -> list:
+    """Замеры клиента из архива (с since, если указано) в виде строк (timestamp, value, period)"""
+    import numpy as np
+
+    if archive is None:
+        until = archive_until(user_id, directory)
+        if until is None or since is not None and until <= since:
+            return []
+        archive = load_archive(user_id, directory)
+
+    timestamps, values, periods = archive.timestamps, archive.values, archive.periods
+    if since is not None:
+        start = np.searchsorted(timestamps, np.datetime64(since, 'us'))
+        timestamps, values, periods = timestamps[start:], values[start:], periods[start:]
+    names = archive.period_names
+    return [ArchivedReading(timestamp, value, names[code])
+            for timestamp, value, code in zip(timestamps.tolist(), values.tolist(), periods.tolist())]
+
+
+def iter_archived_readings(user_id: int, chunk_size: int, directory: str = ARCHIVE_DIR):
+    """Замеры архива порциями по chunk_size строк (для выгрузки: объектов Python не больше порции)"""
+    archive = load_archive(user_id, directory)
+    if archive is None:
+        return
+    names = archive.period_names
+    for start in range(0, len(archive.timestamps), chunk_size):
+        end = start + chunk_size
+        yield [ArchivedReading(timestamp, value, names[code]) for timestamp, value, code in zip(
+            archive.timestamps[start:end].tolist(), archive.values[start:end].tolist(),
+            archive.periods[start:end].tolist()
+        )]
+
+
+def archived_buckets(user_id: int, unit: str = 'day', directory: str = ARCHIVE_DIR):
+    """
+    Агрегаты архива по дню/неделе и периоду в формате buckets_to_arrays
+    :return: (timestamps, средние, period_codes, (минимумы, максимумы, количества)) или None
+    """
+    import numpy as np
+
+    archive = load_archive(user_id, directory)
+    if archive is None or not len(archive.timestamps):
+        return None
+
+    # Коды периодов архива -> коды отрисовки; неизвестные периоды не рисуются, как и из базы
+    codes = np.array([PERIOD_CODES.get(name, -1) for name in archive.period_names], dtype=np.int64)
+    periods = codes[archive.periods]
+    known = periods >= 0
+    days = archive.timestamps[known].astype('datetime64[D]').astype(np.int64)
+    values = archive.values[known]
+    periods = periods[known]
+    if unit == 'week':
+        # 1970-01-01 — четверг: сдвиг к понедельнику той же недели
+        days = days - (days + 3) % 7
+
+    return _group_buckets(days, periods, values, values, values, np.ones(len(values), dtype=np.int64),
+                          day_index=True)
+
+
+def _group_buckets(buckets, periods, means, mins, maxs, counts, day_index: bool = False):
+    """Свести строки с одинаковыми (корзина, период): средние взвешиваются по количеству"""
+    import numpy as np
+
+    order = np.lexsort((periods, buckets))
+    buckets, periods = buckets[order], periods[order]
+    means, mins, maxs, counts = means[order], mins[order], maxs[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, (buckets[1:] != buckets[:-1]) | (periods[1:] != periods[:-1])])
+
+    totals = np.add.reduceat(counts, starts)
+    sums = np.add.reduceat(means * counts, starts)
+    result_buckets = buckets[starts]
+    if day_index:
+        # Номер дня -> начало дня по местному времени, как time.mktime в buckets_to_arrays
+        result_buckets = np.array([
+            time.mktime((date(1970, 1, 1) + timedelta(days=int(day))).timetuple()) for day in result_buckets
+        ], dtype=np.float64)
+    return (
+        result_buckets.astype(np.float64),
+        sums / totals,
+        periods[starts].astype(np.int8),
+        (np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts), totals)
+    )
+
+
+def merge_buckets(hot, archived):
+    """Объединить агрегаты базы и архива (неделя на границе архивации есть в обоих)"""
+    import numpy as np
+
+    if archived is None:
+        return hot
+    if not len(hot[0]):
+        return archived
+    timestamps, means, periods, spread = (
+        np.concatenate([archived[0], hot[0]]),
+        np.concatenate([archived[1], hot[1]]),
+        np.concatenate([archived[2], hot[2]]).astype(np.int64),
+        tuple(np.concatenate([a, h]) for a, h in zip(archived[3], hot[3]))
+    )
+    return _group_buckets(timestamps, periods, means, spread[0], spread[1], spread[2].astype(np.int64))
+
+
+class ArchivedKeys:
+    """
+    Проверка, есть ли замер (timestamp, value, period) в архиве клиента (для загрузки истории)
+    Время сравнивается с точностью до секунды, как при проверке дублей в базе
+    """
+
+    def __init__(self, archive: Archive):
+        self.archive = archive
+
+    def __contains__(self, reading) -> bool:
+        import numpy as np
+
+        timestamp, value, period = reading
+        if timestamp >= self.archive.until:
+            return False
+        second = np.datetime64(timestamp.replace(microsecond=0), 'us')
+        start, end = np.searchsorted(self.archive.timestamps, [second, second + np.timedelta64(1, 's')])
+        names = self.archive.period_names
+        return any(self.archive.values[i] == value and names[self.archive.periods[i]] == period
+                   for i in range(start, end))
+
+    def has_day(self, day) -> bool:
+        """Есть ли в архиве замеры за день (для дневной активности)"""
+        import numpy as np
+
+        start = np.datetime64(day, 'D')
+        first = np.searchsorted(self.archive.timestamps, start)
+        return bool(first < len(self.archive.timestamps) and self.archive.timestamps[first] < start + 1)
+
+
+# ============= НАКОПИТЕЛЬНЫЕ ТАБЛИЦЫ =============
+def _archive_deltas(archive: Archive):
+    """Агрегаты архива по периодам (формат period_stats_params) и гистограмма {(period, tenths): count}"""
+    import numpy as np
+
+    deltas = {}
+    histogram = Counter()
+    tenths = np.floor(archive.values * 10 + 0.5).astype(np.int64)
+    for code, period in enumerate(archive.period_names):
+        mask = archive.periods == code
+        if not mask.any():
+            continue
+        values = archive.values[mask]
+        timestamps = archive.timestamps[mask]
+        deltas[period] = {
+            'count': int(mask.sum()),
+            'value_sum': float(values.sum()),
+            'value_sum_sq': float((values * values).sum()),
+            'min_value': float(values.min()),
+            'max_value': float(values.max()),
+            'first_timestamp': timestamps.min().item(),
+            'last_timestamp': timestamps.max().item(),
+            'in_range': int(((values >= TIME_IN_RANGE[0]) & (values <= TIME_IN_RANGE[1])).sum()),
+            'in_target': int(((values >= TIME_IN_TARGET[0]) & (values <= TIME_IN_TARGET[1])).sum())
+        }
+        for value, count in zip(*np.unique(tenths[mask], return_counts=True)):
+            histogram[(period, int(value))] += int(count)
+    return deltas, histogram
+
+
+def apply_archive_stats(connection, user_id: int = None, directory: str = ARCHIVE_DIR):
+    """Добавить архив к статистике и гистограмме, пересчитанным по glucose_readings"""
+    for archived_user in archived_users(directory) if user_id is None else [user_id]:
+        archive = load_archive(archived_user, directory)
+        if archive is None:
+            continue
+        deltas, histogram = _archive_deltas(archive)
+        connection.execute(period_stats_upsert(), period_stats_params(
+            {(archived_user, period): delta for period, delta in deltas.items()}
+        ))
+        connection.execute(histogram_upsert(), histogram_params(
+            {(archived_user, period, tenths): count for (period, tenths), count in histogram.items()}
+        ))
+
+
+def apply_archive_activity(connection, directory: str = ARCHIVE_DIR):
+    """
+    Добавить архив к daily_activity, пересчитанной по glucose_readings
+    Старые замеры могут попасть в базу и после архивации (загрузка истории), поэтому клиент
+    считается активным по архиву только в дни, когда у него нет замеров в базе
+    """
+    import numpy as np
+
+    readings = Counter()
+    active = Counter()
+    for user_id in archived_users(directory):
+        archive = load_archive(user_id, directory)
+        if archive is None:
+            continue
+        # Драйверы возвращают день как date или datetime — приводим к тем же дням, что и у архива
+        days_in_db = set(np.array(connection.scalars(reading_days_query(user_id, archive.until)).all(),
+                                  dtype='datetime64[D]').tolist())
+        days, counts = np.unique(archive.timestamps.astype('datetime64[D]'), return_counts=True)
+        for day, count in zip(days.tolist(), counts.tolist()):
+            readings[day] += count
+            if day not in days_in_db:
+                active[day] += 1
+
+    if readings:
+        connection.execute(daily_activity_upsert(), daily_activity_params(
+            {day: {'readings': count, 'active_users': active[day]} for day, count in readings.items()}
+        ))
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) == 1:
+        archive_readings()
+    elif len(sys.argv) == 2 and sys.argv[1].isdigit():
+        # archive.py 180 — перенести замеры старше 180 дней
+        archive_readings(int(sys.argv[1]))
+    elif len(sys.argv) == 3 and sys.argv[1] == "restore":
+        restore_user(int(sys.argv[2]))
+    else:
+        print("Использование:")
+        print(f"  python archive.py                - перенести в архив замеры старше {ARCHIVE_AFTER_DAYS} дней")
+        print("  python archive.py ДНЕЙ           - перенести в архив замеры старше указанного числа дней")
+        print("  python archive.py restore VK_ID  - вернуть замеры клиента из архива в базу")
@@ -0,0 +1,273 @@
+"""
+Бенчмарки горячих путей бота на синтетической базе
+Использование:
+  python benchmark.py admin [--users N] [--readings N] [--budget-ms MS]
+  python benchmark.py explain
+  python benchmark.py render [--sizes 10 1000 50000] [--budget-ms MS]
+  python benchmark.py startup [--budget-ms MS] [--repeat N]
+  python benchmark.py stats [--readings N] [--budget-ms MS]
+
+admin по умолчанию проверяет бюджет на 10 000 пользователей и 5 000 000 замеров
+(заполнение базы занимает несколько минут); stats проверяется так же: --readings 5000000
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import create_engine, insert
+
+from database import Base, User, GlucoseReading
+from queries import (
+    clients_overview_query, rebuild_period_stats_statements, readings_window_query,
+    user_histogram_query, user_period_stats_query, rebuild_daily_activity_statements,
+    activity_totals_query
+)
+from renderer import render_chart, _init_worker
+
+# Модули, которые не должны загружаться при запуске бота (нужны только при отрисовке)
+STARTUP_FORBIDDEN = ('matplotlib', 'numpy')
+
+# vkbottle импортируется отдельно: его время не зависит от кода бота
+STARTUP_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+import vkbottle.bot
+vkbottle_loaded = time.perf_counter()
+import bot
+print(vkbottle_loaded - started, time.perf_counter() - vkbottle_loaded)
+print(','.join(name for name in %r if name in sys.modules))
+"""
+
+PERIODS = [
+    'Перед завтраком', 'Перед обедом', 'Перед ужином',
+    'Перед сном', 'Ночью', 'Через час после еды'
+]
+CHUNK_SIZE = 50000
+
+
+def create_bench_engine(path: str):
+    """Отдельная временная база SQLite для бенчмарка"""
+    bench_engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(bench_engine)
+    return bench_engine
+
+
+def populate(bench_engine, users: int, readings: int, seed: int = 42):
+    """Заполнить базу синтетическими пользователями и замерами"""
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    start_date = datetime.now() - timedelta(days=3 * 365)
+
+    with bench_engine.begin() as connection:
+        connection.execute(insert(User), [
+            {'vk_id': 1_000_000 + i, 'name': f'User_{i:05d}', 'is_admin': False,
+             'registered_at': start_date}
+            for i in range(users)
+        ])
+
+    inserted = 0
+    while inserted < readings:
+        size = min(CHUNK_SIZE, readings - inserted)
+        with bench_engine.begin() as connection:
+            connection.execute(insert(GlucoseReading), [
+                {'user_id': 1_000_000 + rng.randrange(users),
+                 'value': round(rng.uniform(3.0, 12.0), 1),
+                 'period': rng.choice(PERIODS),
+                 'timestamp': start_date + timedelta(minutes=rng.randrange(3 * 365 * 24 * 60))}
+                for _ in range(size)
+            ])
+        inserted += size
+
+    with bench_engine.begin() as connection:
+        for statement in (*rebuild_period_stats_statements(), *rebuild_daily_activity_statements()):
+            connection.execute(statement)
+
+    print(f"База заполнена: {users} пользователей, {readings} замеров "
+          f"за {time.perf_counter() - started:.1f} с")
+
+
+def measure(func, repeat: int):
+    """Минимальное и медианное время выполнения в миллисекундах"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def bench_admin(args) -> bool:
+    """Список клиентов и общая статистика админ-панели"""
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_engine = create_bench_engine(os.path.join(tmp, 'bench.db'))
+        populate(bench_engine, args.users, args.readings)
+
+        query = clients_overview_query().order_by(User.name)
+
+        def run():
+            with bench_engine.connect() as connection:
+                return connection.execute(query).all()
+
+        def run_summary():
+            with bench_engine.connect() as connection:
+                return connection.execute(activity_totals_query()).one()
+
+        rows = len(run())
+        best, median = measure(run, args.repeat)
+        summary_best, summary_median = measure(run_summary, args.repeat)
+        bench_engine.dispose()
+
+    print(f"clients_overview: {rows} строк, min {best:.1f} мс, median {median:.1f} мс "
+          f"(бюджет {args.budget_ms} мс)")
+    print(f"admin_summary: min {summary_best:.1f} мс, median {summary_median:.1f} мс")
+    return median <= args.budget_ms
+
+
+def explain_plan(connection, query) -> str:
+    """План выполнения SQLite для запроса SQLAlchemy"""
+    compiled = query.compile(connection)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled.string}", params).all()
+    return "\n".join(row[-1] for row in rows)
+
+
+def bench_explain(args) -> bool:
+    """Выборки за неделю/месяц/всё время идут по покрывающему индексу без сортировки"""
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_engine = create_bench_engine(os.path.join(tmp, 'bench.db'))
+        populate(bench_engine, 100, 20_000)
+
+        ok = True
+        with bench_engine.connect() as connection:
+            connection.exec_driver_sql("ANALYZE")
+            for days in (7, 30, None):
+                plan = explain_plan(connection, readings_window_query(1_000_000, days))
+                uses_index = 'COVERING INDEX ix_glucose_readings_user_ts' in plan
+                sorts = 'TEMP B-TREE' in plan
+                print(f"days={days}: {'✅' if uses_index and not sorts else '❌'} {plan}")
+                ok = ok and uses_index and not sorts
+        bench_engine.dispose()
+    return ok
+
+
+def bench_render(args) -> bool:
+    """Время отрисовки графика в зависимости от числа замеров"""
+    _init_worker()
+    rng = np.random.default_rng(42)
+    ok = True
+
+    for size in args.sizes:
+        timestamps = np.sort(rng.uniform(0, 3 * 365 * 86400, size))
+        values = np.round(rng.uniform(3.0, 12.0, size), 1)
+        periods = rng.integers(0, len(PERIODS), size).astype(np.int8)
+
+        def run():
+            render_chart(timestamps, values, periods, 'Benchmark', 'за всё время')
+
+        best, median = measure(run, args.repeat)
+        print(f"render {size:>7} замеров: min {best:.0f} мс, median {median:.0f} мс")
+        ok = ok and median <= args.budget_ms
+    return ok
+
+
+def bench_stats(args) -> bool:
+    """Статистика пользователя с многолетней историей: накопительные статистика и гистограмма"""
+    from sqlalchemy.orm import Session as BenchSession
+    from repository import summarize_statistics
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_engine = create_bench_engine(os.path.join(tmp, 'bench.db'))
+        populate(bench_engine, 1, args.readings)
+        with bench_engine.connect() as connection:
+            connection.exec_driver_sql("ANALYZE")
+
+        def run():
+            with BenchSession(bench_engine) as session:
+                rows = session.scalars(user_period_stats_query(1_000_000)).all()
+                histogram = session.execute(user_histogram_query(1_000_000)).all()
+            return summarize_statistics(rows, histogram)
+
+        stats = run()
+        best, median = measure(run, args.repeat)
+        bench_engine.dispose()
+
+    print(f"user_statistics: {stats['total']} замеров, медиана {stats['median']:.1f}, "
+          f"TIR {stats['tir']:.0f}%, min {best:.1f} мс, median {median:.1f} мс (бюджет {args.budget_ms} мс)")
+    return median <= args.budget_ms
+
+
+def bench_startup(args) -> bool:
+    """Время импорта bot.py сверх vkbottle и отсутствие тяжёлых модулей при запуске"""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    own, vkbottle = [], []
+    loaded = ''
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, VK_GROUP_TOKEN='benchmark',
+                   DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}")
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT % (STARTUP_FORBIDDEN,)],
+                cwd=app_dir, env=env, capture_output=True, text=True, check=True
+            ).stdout.splitlines()
+            vkbottle_seconds, own_seconds = map(float, output[-2].split())
+            vkbottle.append(vkbottle_seconds * 1000)
+            own.append(own_seconds * 1000)
+            loaded = output[-1]
+
+    own.sort()
+    vkbottle.sort()
+    median = own[len(own) // 2]
+    print(f"startup: vkbottle {vkbottle[len(vkbottle) // 2]:.0f} мс, "
+          f"модули бота min {own[0]:.0f} мс, median {median:.0f} мс (бюджет {args.budget_ms} мс)")
+    if loaded:
+        print(f"❌ При запуске загружены: {loaded}")
+    return median <= args.budget_ms and not loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    admin = subparsers.add_parser('admin', help='админ-панель: список клиентов и общая статистика')
+    admin.add_argument('--users', type=int, default=10_000)
+    admin.add_argument('--readings', type=int, default=5_000_000)
+    admin.add_argument('--budget-ms', type=float, default=250.0)
+    admin.add_argument('--repeat', type=int, default=20)
+    admin.set_defaults(func=bench_admin)
+
+    explain = subparsers.add_parser('explain', help='выборки за окно используют индекс (user_id, timestamp)')
+    explain.set_defaults(func=bench_explain)
+
+    render = subparsers.add_parser('render', help='время отрисовки графика для разного числа замеров')
+    render.add_argument('--sizes', type=int, nargs='+', default=[10, 1_000, 50_000])
+    render.add_argument('--budget-ms', type=float, default=3000.0)
+    render.add_argument('--repeat', type=int, default=3)
+    render.set_defaults(func=bench_render)
+
+    startup = subparsers.add_parser('startup', help='время запуска процесса бота')
+    startup.add_argument('--budget-ms', type=float, default=1000.0)
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    stats = subparsers.add_parser('stats', help='статистика пользователя с длинной историей')
+    stats.add_argument('--readings', type=int, default=100_000)
+    stats.add_argument('--budget-ms', type=float, default=100.0)
+    stats.add_argument('--repeat', type=int, default=20)
+    stats.set_defaults(func=bench_stats)
+
+    args = parser.parse_args()
+    if not args.func(args):
+        print("❌ Проверка не пройдена")
+        sys.exit(1)
+    print("✅ Проверка пройдена")
+
+
+if __name__ == "__main__":
+    main()
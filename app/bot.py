@@ -1,23 +1,44 @@
 from vkbottle.bot import Bot, Message
-from vkbottle import Keyboard, KeyboardButtonColor, Text
-from vkbottle import PhotoMessageUploader
-from sqlalchemy import func, and_
+from vkbottle import PhotoMessageUploader, DocMessagesUploader, VKAPIError
+from sqlalchemy import make_url
+import asyncio
 import logging
-from datetime import datetime, timedelta
-import io
-import matplotlib
-import numpy as np
 import os
+import signal
 import sys
 
 # Добавляем путь к проекту
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from database import Session, User, GlucoseReading
-from config import VK_GROUP_TOKEN, ADMIN_IDS
-
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from config import (
+    check_config, DATABASE_URL, VK_GROUP_TOKEN, RENDER_WORKERS, RENDER_MAX_QUEUE, RENDER_LABEL_LIMIT, CHART_RAW_LIMIT,
+    STATE_BACKEND, STATE_TTL, STATE_MAX_SIZE,
+    WRITE_BEHIND_ENABLED, WRITE_BEHIND_WINDOW_MS, WRITE_BEHIND_MAX_BATCH,
+    VK_API_URL, OUTBOUND_RATE, OUTBOUND_BURST, OUTBOUND_SENDERS, OUTBOUND_MAX_RETRIES,
+    METRICS_PORT, METRICS_HOST, EXPORT_WORKERS, EXPORT_CHUNK_SIZE, IMPORT_MAX_MB
+)
+from database import async_engine
+from queries import window_start
+from repository import (
+    get_or_create_user, get_user, is_admin, get_user_readings,
+    count_user_readings, get_user_statistics, save_glucose_reading,
+    get_admin_summary, get_clients_overview, get_readings_version, get_user_reading_buckets
+)
+from cache import chart_cache, user_cache, invalidate_user_charts, ChartEntry, MISSING
+from keyboards import (
+    MAIN_KEYBOARD, ADMIN_KEYBOARD, ADMIN_PANEL_KEYBOARD, CLIENTS_PAGE_SIZE, CLIENTS_PAGE_PREFIX,
+    EXPORT_PREFIX, EXPORT_ADMINS_OPTION, IMPORT_PREFIX, keyboard_for, clients_keyboard
+)
+from renderer import ChartRenderer, RenderQueueFull, readings_to_arrays
+from dispatcher import Dispatcher
+from state import create_state_store
+from writer import ReadingWriter
+from outbound import OutboundQueue
+from instrumentation import instrument_engine, start_metrics_server
+from metrics import Histogram
+from debug_capture import default_capture
+from export import ReadingExporter, EXPORT_FORMATS
+from import_readings import import_readings, download_document, ImportFileError, ImportInterrupted
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,332 +46,191 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=VK_GROUP_TOKEN)
-
-# Состояния для ожидания ввода показателей
-user_states = {}
-
-
-def create_main_keyboard():
-    """Создание основной клавиатуры с кнопками"""
-    keyboard = Keyboard(one_time=False, inline=False)
-
-    # Первый ряд
-    keyboard.add(Text("🍽 Перед завтраком"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.add(Text("🍽 Перед обедом"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.add(Text("🍽 Перед ужином"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.row()
-
-    # Второй ряд
-    keyboard.add(Text("🌙 Перед сном"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.add(Text("🌃 Ночью"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.row()
-
-    # Третий ряд
-    keyboard.add(Text("⏱ Через час после еды"), color=KeyboardButtonColor.POSITIVE)
-    keyboard.add(Text("📊 График"), color=KeyboardButtonColor.SECONDARY)
-    keyboard.add(Text("📊 Моя статистика"), color=KeyboardButtonColor.SECONDARY)
-    keyboard.row()
-    keyboard.add(Text("📅 За неделю"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.add(Text("📅 За месяц"), color=KeyboardButtonColor.PRIMARY)
-
-    return keyboard
-
-
-def create_admin_keyboard():
-    """Клавиатура для администратора"""
-    keyboard = create_main_keyboard()
-    keyboard.row()
-    keyboard.add(Text("👥 Список клиентов"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.add(Text("📊 Админ панель"), color=KeyboardButtonColor.SECONDARY)
-    return keyboard
-
-
-# ============= ФУНКЦИИ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЯМИ =============
-def get_or_create_user(vk_id: int, name: str = None):
-    """Получить или создать пользователя в базе"""
-    session = Session()
-    try:
-        user = session.query(User).filter_by(vk_id=vk_id).first()
-
-        if not user:
-            # Проверяем, является ли пользователь администратором
-            is_admin = vk_id in ADMIN_IDS
-            user = User(
-                vk_id=vk_id,
-                name=name or f"User_{vk_id}",
-                is_admin=is_admin
-            )
-            session.add(user)
-            session.commit()
-            logger.info(f"Создан новый пользователь: {user.name} (admin={is_admin})")
-
-        return user
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Ошибка в get_or_create_user: {e}")
-        raise
-    finally:
-        session.close()
-
-
-def is_admin(vk_id: int) -> bool:
-    """Проверка, является ли пользователь администратором"""
-    session = Session()
-    try:
-        user = session.query(User).filter_by(vk_id=vk_id).first()
-        return user and user.is_admin
-    finally:
-        session.close()
-
+CHART_STAGE_SECONDS = Histogram('chart_stage_seconds', 'Этапы отправки графика', ('stage',))
 
-def get_all_users():
-    """Получить список всех пользователей (кроме администраторов)"""
-    session = Session()
-    try:
-        users = session.query(User).filter_by(is_admin=False).order_by(User.name).all()
-        return users
-    finally:
-        session.close()
-
-
-def get_user_readings(user_id: int, days: int = None):
-    """
-    Получить показания пользователя
-    :param user_id: ID пользователя
-    :param days: количество дней (None = все дни)
-    """
-    session = Session()
-    try:
-        query = session.query(GlucoseReading).filter_by(user_id=user_id)
+# Число и время запросов к базе по маршрутам
+instrument_engine(async_engine)
 
-        if days is not None:
-            cutoff_date = datetime.now() - timedelta(days=days)
-            query = query.filter(GlucoseReading.timestamp >= cutoff_date)
+check_config()
+bot = Bot(token=VK_GROUP_TOKEN)
+if VK_API_URL:
+    bot.api.API_URL = VK_API_URL
 
-        return query.order_by(GlucoseReading.timestamp).all()
-    finally:
-        session.close()
+# Все ответы идут через очередь с ограничением частоты запросов к VK
+outbound = OutboundQueue(bot.api, rate=OUTBOUND_RATE, burst=OUTBOUND_BURST,
+                         senders=OUTBOUND_SENDERS, max_retries=OUTBOUND_MAX_RETRIES)
+dispatcher = Dispatcher()
 
+# Графики рисуются в отдельных процессах, чтобы не блокировать event loop
+renderer = ChartRenderer(max_workers=RENDER_WORKERS, max_queue=RENDER_MAX_QUEUE,
+                         label_limit=RENDER_LABEL_LIMIT, debug_capture=default_capture())
 
-def get_user_statistics(user_id: int):
-    """Получить полную статистику пользователя за всё время"""
-    session = Session()
-    try:
-        readings = session.query(GlucoseReading).filter_by(user_id=user_id).all()
-
-        if not readings:
-            return {
-                'total': 0,
-                'avg': 0,
-                'min': 0,
-                'max': 0,
-                'by_period': {},
-                'first_date': None,
-                'last_date': None
-            }
-
-        values = [r.value for r in readings]
-
-        # Статистика по периодам
-        periods = {}
-        for reading in readings:
-            if reading.period not in periods:
-                periods[reading.period] = []
-            periods[reading.period].append(reading.value)
-
-        period_stats = {}
-        for period, vals in periods.items():
-            period_stats[period] = {
-                'count': len(vals),
-                'avg': sum(vals) / len(vals),
-                'min': min(vals),
-                'max': max(vals)
-            }
-
-        return {
-            'total': len(readings),
-            'avg': sum(values) / len(values),
-            'min': min(values),
-            'max': max(values),
-            'by_period': period_stats,
-            'first_date': min(r.timestamp for r in readings),
-            'last_date': max(r.timestamp for r in readings)
-        }
-    finally:
-        session.close()
+# Выгрузка замеров в файл в отдельном потоке
+exporter = ReadingExporter(workers=EXPORT_WORKERS, chunk_size=EXPORT_CHUNK_SIZE)
 
+# Загрузки истории идут по одной: параллельные загрузки одного файла задвоили бы замеры
+import_lock = asyncio.Lock()
 
-def save_glucose_reading(user_id: int, value: float, period: str):
-    """Сохранить показание глюкозы"""
-    session = Session()
-    try:
-        reading = GlucoseReading(
-            user_id=user_id,
-            value=value,
-            period=period,
-            timestamp=datetime.now()
-        )
-        session.add(reading)
-        session.commit()
-        logger.info(f"Сохранено показание: {value} для пользователя {user_id}")
+# Состояния для ожидания ввода показателей
+state_store = create_state_store(STATE_BACKEND, STATE_TTL, STATE_MAX_SIZE)
 
-        # Получаем общее количество записей пользователя
-        total = session.query(GlucoseReading).filter_by(user_id=user_id).count()
-        return reading, total
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Ошибка сохранения: {e}")
-        raise
-    finally:
-        session.close()
+# Отложенная запись: замеры за окно сохраняются одной транзакцией
+writer = ReadingWriter(window=WRITE_BEHIND_WINDOW_MS / 1000, max_batch=WRITE_BEHIND_MAX_BATCH) \
+    if WRITE_BEHIND_ENABLED else None
+save_reading = writer.save if writer else save_glucose_reading
 
 
 # ============= ОБРАБОТЧИКИ КОМАНД =============
-@bot.on.message(text=["/start", "старт", "начало", "меню"])
+@dispatcher.route("/start", "старт", "начало", "меню")
 async def start_handler(message: Message):
     """Обработчик команды старт"""
     try:
         # Получаем имя пользователя из VK
-        user_info = await bot.api.users.get(message.from_id)
-        user_name = f"{user_info[0].first_name} {user_info[0].last_name}" if user_info else f"User_{message.from_id}"
+        user_info = await outbound.get_user(message.from_id)
+        user_name = f"{user_info.first_name} {user_info.last_name}" if user_info else f"User_{message.from_id}"
 
-        user = get_or_create_user(message.from_id, user_name)
+        user = await get_or_create_user(message.from_id, user_name)
+        total = await count_user_readings(message.from_id)
         logger.info(f"Пользователь {user.name} запустил бота")
 
         # Выбираем клавиатуру
-        keyboard = create_admin_keyboard() if user.is_admin else create_main_keyboard()
+        keyboard = ADMIN_KEYBOARD if user.is_admin else MAIN_KEYBOARD
 
         # Приветственное сообщение
-        await message.answer(
+        await outbound.reply(
+            message,
             f"👋 Здравствуйте, {user.name}!\n"
-            f"📊 Всего записей: {session.query(GlucoseReading).filter_by(user_id=message.from_id).count()}\n\n"
+            f"📊 Всего записей: {total}\n\n"
             f"Выберите период измерения:",
-            keyboard=keyboard.get_json()
+            keyboard=keyboard
         )
     except Exception as e:
         logger.error(f"Ошибка в start_handler: {e}")
-        await message.answer(
+        await outbound.reply(
+            message,
             "👋 Добро пожаловать!",
-            keyboard=create_main_keyboard().get_json()
+            keyboard=MAIN_KEYBOARD
         )
 
 
-@bot.on.message(text=[
+@dispatcher.route(
     "🍽 Перед завтраком", "🍽 Перед обедом", "🍽 Перед ужином",
     "🌙 Перед сном", "🌃 Ночью", "⏱ Через час после еды"
-])
+)
 async def measurement_time_handler(message: Message):
     """Обработчик выбора времени измерения"""
-    logger.info(f"Выбран период: {message.text}")
+    period = message.text.strip()
+    logger.info(f"Выбран период: {period}")
 
-    user_states[message.from_id] = {
-        'period': message.text,
+    await state_store.set(message.from_id, {
+        'period': period,
         'waiting_for_value': True
-    }
+    })
 
-    period_text = message.text.split(' ', 1)[1] if ' ' in message.text else message.text
+    period_text = period.split(' ', 1)[1] if ' ' in period else period
 
-    await message.answer(
+    await outbound.reply(
+        message,
         f"📝 Введите показатель глюкозы для периода: *{period_text}*\n"
         f"(число от 1.0 до 30.0, например: 5.6)",
-        keyboard=create_main_keyboard().get_json()
+        keyboard=MAIN_KEYBOARD
     )
 
 
-@bot.on.message(text=["📊 График"])
+@dispatcher.route("📊 График")
 async def plot_handler(message: Message):
     """График за всё время"""
-    await message.answer("⏳ Генерирую график за всё время...")
+    await outbound.reply(message, "⏳ Генерирую график за всё время...")
 
     try:
-        readings = get_user_readings(message.from_id, days=None)
+        sent = await generate_and_send_plot(message, message.from_id, days=None)
 
-        if len(readings) < 2:
-            await message.answer(
+        if not sent:
+            await outbound.reply(
+                message,
                 "📭 Недостаточно данных. Нужно минимум 2 замера.",
-                keyboard=create_main_keyboard().get_json()
+                keyboard=MAIN_KEYBOARD
             )
-            return
-
-        await generate_and_send_plot(message, readings, message.from_id)
 
     except Exception as e:
         logger.error(f"Ошибка в plot_handler: {e}")
-        await message.answer(
+        await outbound.reply(
+            message,
             f"❌ Ошибка при создании графика",
-            keyboard=create_main_keyboard().get_json()
+            keyboard=MAIN_KEYBOARD
         )
 
 
-@bot.on.message(text=["📅 За неделю"])
+@dispatcher.route("📅 За неделю")
 async def week_plot_handler(message: Message):
     """График за последнюю неделю"""
-    await message.answer("⏳ Генерирую график за последнюю неделю...")
+    await outbound.reply(message, "⏳ Генерирую график за последнюю неделю...")
 
     try:
-        readings = get_user_readings(message.from_id, days=7)
+        sent = await generate_and_send_plot(message, message.from_id, days=7, period_text="за последнюю неделю")
 
-        if len(readings) < 2:
-            await message.answer(
+        if not sent:
+            await outbound.reply(
+                message,
                 "📭 Недостаточно данных за последнюю неделю",
-                keyboard=create_main_keyboard().get_json()
+                keyboard=MAIN_KEYBOARD
             )
-            return
-
-        await generate_and_send_plot(message, readings, message.from_id, "за последнюю неделю")
 
     except Exception as e:
         logger.error(f"Ошибка в week_plot_handler: {e}")
-        await message.answer(
+        await outbound.reply(
+            message,
             f"❌ Ошибка при создании графика",
-            keyboard=create_main_keyboard().get_json()
+            keyboard=MAIN_KEYBOARD
         )
 
 
-@bot.on.message(text=["📅 За месяц"])
+@dispatcher.route("📅 За месяц")
 async def month_plot_handler(message: Message):
     """График за последний месяц"""
-    await message.answer("⏳ Генерирую график за последний месяц...")
+    await outbound.reply(message, "⏳ Генерирую график за последний месяц...")
 
     try:
-        readings = get_user_readings(message.from_id, days=30)
+        sent = await generate_and_send_plot(message, message.from_id, days=30, period_text="за последний месяц")
 
-        if len(readings) < 2:
-            await message.answer(
+        if not sent:
+            await outbound.reply(
+                message,
                 "📭 Недостаточно данных за последний месяц",
-                keyboard=create_main_keyboard().get_json()
+                keyboard=MAIN_KEYBOARD
             )
-            return
-
-        await generate_and_send_plot(message, readings, message.from_id, "за последний месяц")
 
     except Exception as e:
         logger.error(f"Ошибка в month_plot_handler: {e}")
-        await message.answer(
+        await outbound.reply(
+            message,
             f"❌ Ошибка при создании графика",
-            keyboard=create_main_keyboard().get_json()
+            keyboard=MAIN_KEYBOARD
         )
 
 
-@bot.on.message(text=["📊 Моя статистика"])
+@dispatcher.route("📊 Моя статистика")
 async def my_stats_handler(message: Message):
     """Показать статистику пользователя"""
-    stats = get_user_statistics(message.from_id)
+    stats = await get_user_statistics(message.from_id)
 
     if stats['total'] == 0:
-        await message.answer(
+        await outbound.reply(
+            message,
             "📭 У вас пока нет записей",
-            keyboard=create_main_keyboard().get_json()
+            keyboard=MAIN_KEYBOARD
         )
         return
 
     # Формируем сообщение со статистикой
     text = f"📊 **ВАША СТАТИСТИКА**\n\n"
     text += f"📈 Всего записей: {stats['total']}\n"
-    text += f"📉 Среднее: {stats['avg']:.1f} ммоль/л\n"
+    text += f"📉 Среднее: {stats['avg']:.1f} ± {stats['sd']:.1f} ммоль/л\n"
+    text += f"〰️ Медиана: {stats['median']:.1f} (50% замеров: {stats['p25']:.1f}–{stats['p75']:.1f})\n"
     text += f"⬇️ Мин: {stats['min']:.1f}\n"
     text += f"⬆️ Макс: {stats['max']:.1f}\n"
+    text += f"🎯 В диапазоне 4.0–7.0: {stats['tir']:.0f}%\n"
+    text += f"🎯 В целевом 5.1–7.0: {stats['tir_target']:.0f}%\n"
 
     if stats['first_date']:
         text += f"📅 Первая запись: {stats['first_date'].strftime('%d.%m.%Y')}\n"
@@ -359,292 +239,415 @@ async def my_stats_handler(message: Message):
     text += f"📊 **По периодам:**\n"
     for period, pstats in stats['by_period'].items():
         text += f"• {period}: {pstats['count']} зап., "
-        text += f"ср. {pstats['avg']:.1f} "
-        text += f"({pstats['min']:.1f}-{pstats['max']:.1f})\n"
+        text += f"ср. {pstats['avg']:.1f} ± {pstats['sd']:.1f}, мед. {pstats['median']:.1f} "
+        text += f"({pstats['min']:.1f}-{pstats['max']:.1f}), "
+        text += f"в диапазоне {pstats['tir']:.0f}%\n"
 
-    keyboard = create_admin_keyboard() if is_admin(message.from_id) else create_main_keyboard()
-    await message.answer(text, keyboard=keyboard.get_json())
+    keyboard = await keyboard_for(message.from_id)
+    await outbound.reply(message, text, keyboard=keyboard)
 
 
 # ============= АДМИНИСТРАТИВНЫЕ ОБРАБОТЧИКИ =============
-@bot.on.message(text=["👥 Список клиентов"])
-async def list_clients_handler(message: Message):
-    """Показать список всех клиентов"""
-    if not is_admin(message.from_id):
-        await message.answer("❌ Нет прав администратора")
+@dispatcher.route("👥 Список клиентов")
+async def list_clients_handler(message: Message, page: int = 1):
+    """Показать список клиентов постранично"""
+    if not await is_admin(message.from_id):
+        await outbound.reply(message, "❌ Нет прав администратора")
         return
 
-    users = get_all_users()
+    page = max(page, 1)
+    # Запрашиваем на одного больше, чтобы понять, есть ли следующая страница
+    users = await get_clients_overview(limit=CLIENTS_PAGE_SIZE + 1, offset=(page - 1) * CLIENTS_PAGE_SIZE)
 
-    if not users:
-        await message.answer("📭 Нет зарегистрированных клиентов")
+    if not users and page == 1:
+        await outbound.reply(message, "📭 Нет зарегистрированных клиентов")
         return
 
-    keyboard = Keyboard(one_time=True, inline=False)
-
-    for user in users:
-        session = Session()
-        readings_count = session.query(GlucoseReading).filter_by(user_id=user.vk_id).count()
-        session.close()
-
-        button_text = f"{user.vk_id}:{user.name} ({readings_count} зап.)"
-        keyboard.add(Text(button_text), color=KeyboardButtonColor.PRIMARY)
-        keyboard.row()
+    has_next = len(users) > CLIENTS_PAGE_SIZE
+    await outbound.reply(
+        message,
+        f"👥 Список клиентов (стр. {page}):",
+        keyboard=clients_keyboard(users[:CLIENTS_PAGE_SIZE], page, has_next)
+    )
 
-    keyboard.add(Text("🔙 Назад"), color=KeyboardButtonColor.SECONDARY)
 
-    await message.answer(
-        "👥 Список клиентов:",
-        keyboard=keyboard.get_json()
-    )
+@dispatcher.prefix(CLIENTS_PAGE_PREFIX)
+async def clients_page_handler(message: Message, page: str):
+    """Страница списка клиентов"""
+    if not page.isdigit():
+        await list_clients_handler(message)
+        return
+    await list_clients_handler(message, page=int(page))
 
 
-@bot.on.message(text=["📊 Админ панель"])
+@dispatcher.route("📊 Админ панель")
 async def admin_panel_handler(message: Message):
     """Административная панель"""
-    if not is_admin(message.from_id):
+    if not await is_admin(message.from_id):
         return
 
-    session = Session()
-    total_users = session.query(User).count()
-    total_readings = session.query(GlucoseReading).count()
-    today = datetime.now().date()
-    today_readings = session.query(GlucoseReading).filter(
-        func.date(GlucoseReading.timestamp) == today
-    ).count()
-    session.close()
-
-    keyboard = Keyboard(inline=False)
-    keyboard.add(Text("👥 Список клиентов"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.row()
-    keyboard.add(Text("📊 Общая статистика"), color=KeyboardButtonColor.PRIMARY)
-    keyboard.row()
-    keyboard.add(Text("🔙 Назад"), color=KeyboardButtonColor.SECONDARY)
-
-    await message.answer(
+    total_users, total_readings, today_readings, today_active = await get_admin_summary()
+
+    await outbound.reply(
+        message,
         f"📊 Админ панель\n\n"
         f"Клиентов: {total_users}\n"
         f"Замеров: {total_readings}\n"
-        f"Замеров сегодня: {today_readings}",
-        keyboard=keyboard.get_json()
+        f"Замеров сегодня: {today_readings}\n"
+        f"Активных сегодня: {today_active}",
+        keyboard=ADMIN_PANEL_KEYBOARD
     )
 
 
-@bot.on.message(text=["📊 Общая статистика"])
+@dispatcher.route("📊 Общая статистика")
 async def overall_stats_handler(message: Message):
     """Показать общую статистику"""
-    if not is_admin(message.from_id):
+    if not await is_admin(message.from_id):
         return
 
-    session = Session()
-    users = session.query(User).filter_by(is_admin=False).all()
-
     stats_text = "📊 Общая статистика:\n\n"
 
-    for user in users:
-        readings = session.query(GlucoseReading).filter_by(user_id=user.vk_id).all()
-        if readings:
-            values = [r.value for r in readings]
+    for user in await get_clients_overview():
+        if user.readings:
             stats_text += f"👤 {user.name}:\n"
-            stats_text += f"   Замеров: {len(readings)}\n"
-            stats_text += f"   Среднее: {np.mean(values):.1f}\n\n"
-
-    session.close()
+            stats_text += f"   Замеров: {user.readings}\n"
+            stats_text += f"   Среднее: {user.avg:.1f}\n"
+            stats_text += f"   В диапазоне 4.0–7.0: {user.tir:.0f}%\n\n"
 
-    keyboard = create_admin_keyboard()
-    await message.answer(stats_text, keyboard=keyboard.get_json())
+    await outbound.reply(message, stats_text, keyboard=ADMIN_KEYBOARD)
 
 
-@bot.on.message(text=["🔙 Назад"])
-async def back_handler(message: Message):
-    """Вернуться в главное меню"""
-    keyboard = create_admin_keyboard() if is_admin(message.from_id) else create_main_keyboard()
-    await message.answer("Главное меню:", keyboard=keyboard.get_json())
+@dispatcher.prefix(EXPORT_PREFIX)
+async def export_handler(message: Message, args: str):
+    """Выгрузка замеров клиента или всех клиентов в CSV/XLSX документом VK"""
+    if not await is_admin(message.from_id):
+        await outbound.reply(message, "❌ Нет прав администратора")
+        return
 
+    user_id = None
+    fmt = 'csv'
+    # Замеры администраторов попадают в выгрузку всех клиентов только по явной просьбе
+    include_admins = False
+    for token in args.split():
+        if token.isdigit():
+            user_id = int(token)
+        elif token.lower() in EXPORT_FORMATS:
+            fmt = token.lower()
+        elif token.lower() == EXPORT_ADMINS_OPTION:
+            include_admins = True
+        else:
+            await outbound.reply(
+                message, f"Использование: {EXPORT_PREFIX} [VK ID] [csv|xlsx] [{EXPORT_ADMINS_OPTION}]"
+            )
+            return
 
-# ============= УНИВЕРСАЛЬНЫЙ ОБРАБОТЧИК =============
-@bot.on.message()
-async def universal_handler(message: Message):
-    """Единый универсальный обработчик"""
-    logger.info(f"Универсальный обработчик: '{message.text}'")
+    if user_id is not None and not await get_user(user_id):
+        await outbound.reply(message, "❌ Клиент не найден")
+        return
 
-    # СЛУЧАЙ 1: Обработка кнопок меню
-    if message.text == "📊 Моя статистика":
-        await my_stats_handler(message)
+    await outbound.reply(message, "⏳ Готовлю выгрузку...")
+    try:
+        result = await exporter.export(user_id, fmt, include_admins)
+    except RuntimeError as e:
+        await outbound.reply(message, f"❌ {e}")
         return
 
-    if message.text == "📊 График":
-        await plot_handler(message)
+    try:
+        if not result.rows:
+            await outbound.reply(message, "📭 Нет замеров для выгрузки")
+            return
+
+        # Загрузка документа — два вызова API, они тоже учитываются в лимите частоты
+        await outbound.bucket.acquire()
+        await outbound.bucket.acquire()
+        doc = await DocMessagesUploader(bot.api).upload(
+            file_source=result.path,
+            peer_id=message.peer_id,
+            title=result.title
+        )
+        await outbound.reply(
+            message,
+            f"📤 Выгрузка: {result.rows} замеров",
+            attachment=doc,
+            keyboard=ADMIN_PANEL_KEYBOARD
+        )
+    finally:
+        exporter.remove(result.path)
+
+
+@dispatcher.prefix(IMPORT_PREFIX)
+async def import_handler(message: Message, args: str):
+    """Загрузка истории замеров из CSV-документа, приложенного к сообщению"""
+    if not await is_admin(message.from_id):
+        await outbound.reply(message, "❌ Нет прав администратора")
         return
 
-    if message.text == "📅 За неделю":
-        await week_plot_handler(message)
+    args = args.strip()
+    docs = [attachment.doc for attachment in message.attachments or [] if attachment.doc]
+    if not docs or args and not args.isdigit():
+        await outbound.reply(
+            message,
+            f"📥 Приложите CSV-файл к сообщению «{IMPORT_PREFIX} VK_ID».\n"
+            f"Колонки: дата и время, значение, период; VK ID не нужен, если в файле есть колонка vk_id"
+        )
         return
 
-    if message.text == "📅 За месяц":
-        await month_plot_handler(message)
+    doc = docs[0]
+    max_bytes = int(IMPORT_MAX_MB * (1 << 20))
+    if doc.size and doc.size > max_bytes:
+        await outbound.reply(message, f"❌ Файл больше {IMPORT_MAX_MB:g} МБ")
         return
 
-    # СЛУЧАЙ 2: Мы ждем ввод глюкозы
-    if message.from_id in user_states and user_states[message.from_id].get('waiting_for_value'):
+    await outbound.reply(message, "⏳ Загружаю замеры...")
+    async with import_lock:
+        path = None
+        try:
+            path = await download_document(doc.url, max_bytes)
+            # Разбор файла и вставка — синхронный код, выполняется в отдельном потоке
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, import_readings, path, int(args) if args else None, doc.title
+            )
+        except ImportFileError as e:
+            await outbound.reply(message, f"❌ {e}")
+            return
+        except ImportInterrupted as e:
+            logger.error(f"Ошибка в import_handler: {e}")
+            await outbound.reply(
+                message,
+                f"❌ Загрузка #{e.job_id} прервана сбоем. Отправьте тот же файл ещё раз — "
+                f"уже сохранённые замеры останутся, загрузка продолжится с места остановки",
+                keyboard=ADMIN_PANEL_KEYBOARD
+            )
+            return
+        except Exception as e:
+            logger.error(f"Ошибка в import_handler: {e}")
+            await outbound.reply(message, "❌ Не удалось скачать или загрузить файл, попробуйте ещё раз",
+                                 keyboard=ADMIN_PANEL_KEYBOARD)
+            return
+        finally:
+            if path:
+                os.remove(path)
+
+    for vk_id in result.user_ids:
+        user_cache.invalidate(vk_id)
+        invalidate_user_charts(vk_id)
+
+    if result.status == 'already':
+        text = "ℹ️ Этот файл уже загружен"
+    else:
+        text = (f"✅ Загрузка завершена\n"
+                f"Добавлено: {result.inserted}\n"
+                f"Уже были: {result.duplicates}\n"
+                f"Отклонено: {result.rejected}")
+        if result.errors:
+            text += "\n\n" + "\n".join(result.errors)
+    await outbound.reply(message, text, keyboard=ADMIN_PANEL_KEYBOARD)
+
+
+@dispatcher.route("🔙 Назад")
+async def back_handler(message: Message):
+    """Вернуться в главное меню"""
+    keyboard = await keyboard_for(message.from_id)
+    await outbound.reply(message, "Главное меню:", keyboard=keyboard)
+
+
+# ============= УНИВЕРСАЛЬНЫЙ ОБРАБОТЧИК =============
+@dispatcher.fallback
+async def universal_handler(message: Message):
+    """Сообщения, не совпавшие ни с одной командой меню"""
+    logger.debug(f"Универсальный обработчик: '{message.text}'")
+
+    # СЛУЧАЙ 1: Мы ждем ввод глюкозы (состояние проверяется до любых запросов к users)
+    state = await state_store.get(message.from_id)
+    if state and state.get('waiting_for_value'):
         try:
             # Заменяем запятую на точку для корректного преобразования
             value = float(message.text.replace(',', '.'))
 
             if value < 1.0 or value > 30.0:
-                await message.answer("⚠️ Значение должно быть от 1.0 до 30.0 ммоль/л")
+                await outbound.reply(message, "⚠️ Значение должно быть от 1.0 до 30.0 ммоль/л")
                 return
 
-            period = user_states[message.from_id]['period']
+            period = state['period']
             clean_period = period.split(' ', 1)[1] if ' ' in period else period
 
             # Сохраняем в базу
-            reading, total = save_glucose_reading(message.from_id, value, clean_period)
+            reading, total = await save_reading(message.from_id, value, clean_period)
 
-            del user_states[message.from_id]
+            await state_store.delete(message.from_id)
 
-            keyboard = create_admin_keyboard() if is_admin(message.from_id) else create_main_keyboard()
+            keyboard = await keyboard_for(message.from_id)
 
-            await message.answer(
+            await outbound.reply(
+                message,
                 f"✅ Сохранено: {value} ммоль/л\n"
                 f"Период: {clean_period}\n"
                 f"Всего записей: {total}",
-                keyboard=keyboard.get_json()
+                keyboard=keyboard
             )
             return
 
         except ValueError:
-            await message.answer("❌ Введите число (пример: 5,6 или 5.6)")
+            await outbound.reply(message, "❌ Введите число (пример: 5,6 или 5.6)")
             return
 
-    # СЛУЧАЙ 3: Админ выбирает клиента (сообщение начинается с цифр и содержит двоеточие)
-    if (is_admin(message.from_id) and
-            message.text and
+    # СЛУЧАЙ 2: Админ выбирает клиента (сообщение начинается с цифр и содержит двоеточие)
+    # Права проверяем только если текст похож на выбор клиента
+    if (message.text and
             message.text[0].isdigit() and
-            ':' in message.text):
+            ':' in message.text and
+            await is_admin(message.from_id)):
 
         try:
             vk_id = int(message.text.split(':')[0].strip())
 
-            session = Session()
-            user = session.query(User).filter_by(vk_id=vk_id).first()
-            readings = session.query(GlucoseReading).filter_by(user_id=vk_id).all()
-            session.close()
+            user = await get_user(vk_id)
 
             if not user:
-                await message.answer("❌ Клиент не найден")
-                return
-
-            if len(readings) < 2:
-                await message.answer(f"📭 У клиента {user.name} недостаточно данных")
+                await outbound.reply(message, "❌ Клиент не найден")
                 return
 
-            await message.answer(f"⏳ График для {user.name}...")
-            await generate_and_send_plot(message, readings, vk_id, user.name)
+            await outbound.reply(message, f"⏳ График для {user.name}...")
+            if not await generate_and_send_plot(message, vk_id, period_text=user.name):
+                await outbound.reply(message, f"📭 У клиента {user.name} недостаточно данных")
+            else:
+                await outbound.reply(message, f"Выгрузить дневник: {EXPORT_PREFIX} {vk_id} [csv|xlsx]")
             return
 
         except Exception as e:
             logger.error(f"Ошибка выбора клиента: {e}")
 
-    # СЛУЧАЙ 4: Всё остальное - неизвестная команда
-    keyboard = create_admin_keyboard() if is_admin(message.from_id) else create_main_keyboard()
-    await message.answer(
+    # СЛУЧАЙ 3: Всё остальное - неизвестная команда
+    keyboard = await keyboard_for(message.from_id)
+    await outbound.reply(
+        message,
         "❓ Используйте кнопки меню",
-        keyboard=keyboard.get_json()
+        keyboard=keyboard
     )
 
 
+@bot.on.message()
+async def message_handler(message: Message):
+    """Единая точка входа: маршрутизация через диспетчер команд"""
+    await dispatcher.dispatch(message)
+
+
 # ============= ФУНКЦИЯ ДЛЯ ГЕНЕРАЦИИ ГРАФИКА =============
-async def generate_and_send_plot(message: Message, readings: list, user_id: int, period_text: str = "за всё время"):
-    """Универсальная функция для создания и отправки графика"""
+async def generate_and_send_plot(message: Message, user_id: int, days: int = None,
+                                 period_text: str = "за всё время") -> bool:
+    """
+    Универсальная функция для создания и отправки графика
+    Повторный просмотр тех же данных берётся из кэша без отрисовки и загрузки в VK
+    :return: False, если для графика недостаточно данных (меньше 2 замеров)
+    """
     try:
-        session = Session()
-        user = session.query(User).filter_by(vk_id=user_id).first()
-        user_name = user.name if user else f"User_{user_id}"
-        session.close()
-
-        logger.info(f"Создание графика для {user_name}, записей: {len(readings)}")
-
-        fig, ax = plt.subplots(figsize=(14, 8))
-
-        all_periods = [
-            'Перед завтраком', 'Перед обедом', 'Перед ужином',
-            'Перед сном', 'Ночью', 'Через час после еды'
-        ]
-
-        periods_data = {period: [] for period in all_periods}
-        for reading in readings:
-            if reading.period in periods_data:
-                periods_data[reading.period].append(reading.value)
-
-        x_positions = range(len(all_periods))
-        all_values = []
-
-        for i, period in enumerate(all_periods):
-            values = periods_data[period]
-            if values:
-                all_values.extend(values)
-                x_jitter = np.random.normal(i, 0.05, len(values))
-                color = 'orange' if period == 'Через час после еды' else 'blue'
-
-                ax.scatter(x_jitter, values, color=color, s=150,
-                           zorder=5, edgecolors='black', linewidth=2, alpha=0.8)
-
-                for j, (x, y) in enumerate(zip(x_jitter, values)):
-                    ax.annotate(f'{y:.1f}', (x, y), xytext=(0, 15),
-                                textcoords='offset points', ha='center', fontsize=9,
-                                bbox=dict(boxstyle='round,pad=0.2', facecolor='white', alpha=0.9))
-
-        ax.axhline(y=5.1, color='green', linewidth=2, linestyle='-', alpha=0.7, label='Цель 5.1')
-        ax.axhline(y=7.0, color='red', linewidth=2, linestyle='-', alpha=0.7, label='Граница 7.0')
-        ax.axhspan(5.1, 7.0, alpha=0.15, color='green')
-
-        ax.set_xticks(x_positions)
-        ax.set_xticklabels(all_periods, rotation=45, ha='right', fontsize=11)
-        ax.set_ylabel('Глюкоза (ммоль/л)', fontsize=12)
-        ax.set_title(f'График глюкозы: {user_name} ({period_text})',
-                     fontsize=16, fontweight='bold')
-        ax.grid(True, alpha=0.3, linestyle='--', axis='y')
-        ax.legend(loc='upper right')
-
-        if all_values:
-            stats_text = f"Всего замеров: {len(readings)}\n"
-            stats_text += f"Среднее: {np.mean(all_values):.1f}\n"
-            stats_text += f"Мин: {np.min(all_values):.1f}\n"
-            stats_text += f"Макс: {np.max(all_values):.1f}"
-
-            ax.text(1.02, 0.98, stats_text, transform=ax.transAxes,
-                    fontsize=9, verticalalignment='top',
-                    bbox=dict(boxstyle='round', facecolor='white', alpha=0.9))
-
-        plt.tight_layout()
-
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=120, bbox_inches='tight')
-        buffer.seek(0)
-        plt.close(fig)
-
-        photo_uploader = PhotoMessageUploader(bot.api)
-        photo = await photo_uploader.upload(
-            file_source=buffer.getvalue(),
-            peer_id=message.peer_id
-        )
-
-        keyboard = create_admin_keyboard() if is_admin(message.from_id) else create_main_keyboard()
-        await message.answer(
-            f"📊 График {period_text}:",
-            attachment=photo,
-            keyboard=keyboard.get_json()
-        )
+        with CHART_STAGE_SECONDS.time(stage='version'):
+            version = await get_readings_version(user_id)
+        # Для окон учитываем начало окна: старые замеры выпадают из него со временем
+        cache_key = (user_id, days, period_text, version, window_start(days) if days else None)
+        chart = chart_cache.get(cache_key)
+
+        if chart is MISSING:
+            total, first_timestamp, last_timestamp = version
+            spread = None
+            chart_title = period_text
+
+            with CHART_STAGE_SECONDS.time(stage='query'):
+                if days is None and (total or 0) > CHART_RAW_LIMIT:
+                    # Большая история: агрегаты по дням/неделям считает база
+                    long_history = (last_timestamp - first_timestamp).days > 365
+                    unit = 'week' if long_history else 'day'
+                    timestamps, values, periods, spread = await get_user_reading_buckets(user_id, unit)
+                    chart_title = f"{period_text}, средние {'по неделям' if long_history else 'по дням'}"
+                else:
+                    readings = await get_user_readings(user_id, days)
+                    if len(readings) < 2:
+                        return False
+                    timestamps, values, periods = readings_to_arrays(readings)
+
+            user = await get_user(user_id)
+            user_name = user.name if user else f"User_{user_id}"
+
+            logger.debug(f"Создание графика для {user_name}, точек: {len(values)}")
+
+            try:
+                with CHART_STAGE_SECONDS.time(stage='render'):
+                    png = await renderer.render(timestamps, values, periods, user_name, chart_title, spread)
+            except RenderQueueFull:
+                await outbound.reply(message, "⏳ Сейчас строится много графиков, попробуйте через минуту")
+                return True
+
+            chart = ChartEntry(png)
+            chart_cache.set(cache_key, chart)
+
+        keyboard = await keyboard_for(message.from_id)
+
+        if chart.attachment is not None:
+            try:
+                with CHART_STAGE_SECONDS.time(stage='send'):
+                    await outbound.reply(
+                        message,
+                        f"📊 График {period_text}:",
+                        attachment=chart.attachment,
+                        keyboard=keyboard
+                    )
+                return True
+            except VKAPIError as e:
+                # Вложение стало недоступно — загрузим PNG заново
+                logger.warning(f"Кэшированное вложение не отправлено: {e}")
+
+        with CHART_STAGE_SECONDS.time(stage='upload'):
+            # Загрузка фото — два вызова API, они тоже учитываются в лимите частоты
+            await outbound.bucket.acquire()
+            await outbound.bucket.acquire()
+            photo_uploader = PhotoMessageUploader(bot.api)
+            photo = await photo_uploader.upload(
+                file_source=chart.png,
+                peer_id=message.peer_id
+            )
+        chart_cache.set(cache_key, chart._replace(attachment=photo))
+
+        with CHART_STAGE_SECONDS.time(stage='send'):
+            await outbound.reply(
+                message,
+                f"📊 График {period_text}:",
+                attachment=photo,
+                keyboard=keyboard
+            )
+        return True
 
     except Exception as e:
         logger.error(f"Ошибка генерации графика: {e}")
         raise
 
 
+async def startup():
+    """Запуск фоновых сервисов вместе с ботом"""
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT, METRICS_HOST)
+
+
+async def shutdown():
+    """Остановка фоновых сервисов при завершении бота"""
+    if writer:
+        await writer.close()
+    await outbound.close()
+    renderer.shutdown()
+    exporter.shutdown()
+    await async_engine.dispose()
+
+
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+
 if __name__ == "__main__":
     logger.info("=" * 50)
     logger.info("🚀 ЗАПУСК БОТА ДЛЯ КОНТРОЛЯ ГЛЮКОЗЫ")
-    logger.info(f"📁 База данных: {os.path.abspath('data/glucose.db')}")
+    logger.info(f"📁 База данных: {make_url(DATABASE_URL).render_as_string(hide_password=True)}")
     logger.info("=" * 50)
+    # SIGTERM (docker stop) завершает бота так же, как Ctrl+C: очередь замеров успевает записаться
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    bot.loop_wrapper.on_startup.append(startup())
+    bot.loop_wrapper.on_shutdown.append(shutdown())
     bot.run_forever()
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""
+Кэши в памяти процесса: LRU с ограничением размера и временем жизни записей
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, CHART_CACHE_SIZE, CHART_CACHE_TTL
+from metrics import Counter
+
+CACHE_HITS = Counter('cache_hits_total', 'Попадания в кэш', ('cache',))
+CACHE_MISSES = Counter('cache_misses_total', 'Промахи кэша', ('cache',))
+
+# Отличает «нет в кэше» от закэшированного None
+MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш с ограничением размера и временем жизни записей"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    CACHE_HITS.inc(cache=self.name)
+                    return value
+                del self._data[key]
+        CACHE_MISSES.inc(cache=self.name)
+        return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        """Удалить все записи, ключ которых удовлетворяет условию"""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class UserProfile(NamedTuple):
+    """Неизменяемый профиль пользователя для кэша"""
+    vk_id: int
+    name: str
+    is_admin: bool
+
+
+class ChartEntry(NamedTuple):
+    """Готовый график: PNG и вложение VK после загрузки (None, пока не загружен)"""
+    png: bytes
+    attachment: str = None
+
+
+# Профили пользователей по vk_id (None — пользователь не зарегистрирован)
+user_cache = TTLCache('user_profile', USER_CACHE_SIZE, USER_CACHE_TTL)
+# Имя версии профилей в cache_versions: скрипты, меняющие пользователей, увеличивают её,
+# и бот сбрасывает user_cache во всех процессах
+USER_CACHE_VERSION = 'user_profile'
+
+# Графики по (vk_id, окно в днях, подпись, версия данных, дата для окон)
+chart_cache = TTLCache('chart', CHART_CACHE_SIZE, CHART_CACHE_TTL)
+
+
+def invalidate_user_charts(vk_id: int):
+    """Сбросить все графики пользователя (после нового замера)"""
+    chart_cache.invalidate_matching(lambda key: key[0] == vk_id)
@@ -0,0 +1,190 @@
+"""
+Запуск бота в нескольких процессах
+Один процесс-приёмник получает события long poll и раздаёт их процессам-обработчикам
+по from_id: сообщения одного пользователя всегда попадают в один процесс и обрабатываются по порядку
+
+Использование:
+    python cluster.py [--workers N]                      # события из VK
+    python cluster.py --record updates.jsonl             # то же, с записью событий в файл
+    python cluster.py --replay updates.jsonl [--delay S] # проигрывание записанных событий
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from config import (
+    check_config, VK_GROUP_TOKEN, VK_API_URL, BOT_WORKERS, METRICS_PORT, METRICS_HOST,
+    OUTBOUND_RATE, OUTBOUND_BURST
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: dict) -> int:
+    """VK ID отправителя события (0, если событие не связано с пользователем)"""
+    obj = update.get('object') or {}
+    message = obj.get('message') or {}
+    return message.get('from_id') or obj.get('user_id') or obj.get('from_id') or 0
+
+
+def shard_for(update: dict, workers: int) -> int:
+    """Номер процесса-обработчика для события"""
+    return update_user_id(update) % workers
+
+
+# ============= ИСТОЧНИКИ СОБЫТИЙ =============
+async def vk_source(token: str):
+    """События long poll сообщества VK"""
+    from vkbottle import API
+    from vkbottle.polling import BotPolling
+
+    api = API(token)
+    if VK_API_URL:
+        api.API_URL = VK_API_URL
+    async for event in BotPolling(api).listen():
+        yield event
+
+
+async def replay_source(path: str, delay: float = 0.0):
+    """
+    События из файла JSONL: в строке либо одно событие,
+    либо ответ long poll целиком ({"ts": ..., "updates": [...]})
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            yield data if 'updates' in data else {'updates': [data]}
+            if delay:
+                await asyncio.sleep(delay)
+
+
+# ============= ПРИЁМНИК =============
+async def receive(source, queues, record_path: str = None):
+    """Раздать события из источника по очередям обработчиков"""
+    record = open(record_path, 'a', encoding='utf-8') if record_path else None
+    received = 0
+    try:
+        async for event in source:
+            for update in event.get('updates', []):
+                if record:
+                    record.write(json.dumps(update, ensure_ascii=False) + '\n')
+                queues[shard_for(update, len(queues))].put(update)
+                received += 1
+    finally:
+        if record:
+            record.close()
+        logger.info(f"Приёмник остановлен, получено событий: {received}")
+
+
+# ============= ОБРАБОТЧИК =============
+async def consume(queue, route, on_stop):
+    """
+    Обработать события из очереди
+    События разных пользователей выполняются параллельно, одного пользователя — последовательно
+    """
+    loop = asyncio.get_running_loop()
+    chains = {}  # VK ID -> последняя задача пользователя
+
+    async def run_after(previous, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await route(update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки события: {e}")
+
+    def forget(user_id, task):
+        if chains.get(user_id) is task:
+            del chains[user_id]
+
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        user_id = update_user_id(update)
+        task = loop.create_task(run_after(chains.get(user_id), update))
+        chains[user_id] = task
+        task.add_done_callback(lambda t, user_id=user_id: forget(user_id, t))
+
+    if chains:
+        await asyncio.wait(list(chains.values()))
+    await on_stop()
+
+
+def run_worker(index: int, queue, workers: int = 1):
+    """Точка входа процесса-обработчика"""
+    # Ctrl+C получает вся группа процессов; обработчик останавливается по сигналу приёмника,
+    # дописав уже полученные события
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import bot as bot_module
+    from instrumentation import start_metrics_server
+
+    # Лимит VK общий для токена сообщества: каждый обработчик отправляет свою долю
+    bot_module.outbound.limit_rate(OUTBOUND_RATE / workers, OUTBOUND_BURST // workers)
+
+    async def route(update):
+        await bot_module.bot.router.route(update, bot_module.bot.api)
+
+    async def main():
+        # У каждого обработчика свой эндпоинт метрик: METRICS_PORT + номер
+        if METRICS_PORT:
+            await start_metrics_server(METRICS_PORT + index, METRICS_HOST)
+        await consume(queue, route, bot_module.shutdown)
+
+    logger.info(f"Обработчик {index} запущен (pid {os.getpid()})")
+    asyncio.run(main())
+    logger.info(f"Обработчик {index} остановлен")
+
+
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бот в нескольких процессах")
+    parser.add_argument('--workers', type=int, default=BOT_WORKERS, help="Число процессов-обработчиков")
+    parser.add_argument('--replay', metavar='FILE', help="Проиграть события из файла JSONL вместо VK")
+    parser.add_argument('--delay', type=float, default=0.0, help="Пауза между событиями при проигрывании (с)")
+    parser.add_argument('--record', metavar='FILE', help="Дописывать полученные события в файл JSONL")
+    args = parser.parse_args()
+    check_config()
+
+    queues = [multiprocessing.Queue() for _ in range(args.workers)]
+    workers = [multiprocessing.Process(target=run_worker, args=(index, queue, args.workers), name=f"bot-worker-{index}")
+               for index, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+
+    source = replay_source(args.replay, args.delay) if args.replay else vk_source(VK_GROUP_TOKEN)
+    logger.info(f"🚀 Приёмник запущен: {args.workers} обработчик(ов), "
+                f"источник: {args.replay or 'VK long poll'}")
+
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    try:
+        asyncio.run(receive(source, queues, args.record))
+    except KeyboardInterrupt:
+        logger.info("Остановка по сигналу")
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,87 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, Float, DateTime, String, Boolean, ForeignKey
+from sqlalchemy import create_engine, event, make_url, Column, Integer, Float, Date, DateTime, String, Boolean, ForeignKey, Index, JSON
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime
 import logging
 
-logging.basicConfig(level=logging.INFO)
+from config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE
+
 logger = logging.getLogger(__name__)
 
-# Путь к базе данных
-#DB_PATH = '/app/data/glucose.db' if os.path.exists('/app') else 'data/glucose.db'
-#os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+# Асинхронные драйверы для синхронных URL из конфигурации
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+}
+
+
+def async_database_url(url: str):
+    """URL базы с асинхронным драйвером (sqlite:// -> sqlite+aiosqlite://)"""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+def ensure_database_dir(url: str = DATABASE_URL):
+    """Создать папку для файла SQLite (вызывается из миграции, не при импорте)"""
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(url.database)), exist_ok=True)
+
 
-# Настройка базы данных
-#engine = create_engine(f'sqlite:///{DB_PATH}?check_same_thread=False')
-#Session = sessionmaker(bind=engine)
-#Base = declarative_base()
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == 'sqlite'
+IS_POSTGRESQL = make_url(DATABASE_URL).get_backend_name() == 'postgresql'
 
-# Явно указываем путь к папке проекта на Windows
-PROJECT_PATH = r'E:\BotVK\app'  # <-- Укажите ваш реальный путь
-DB_PATH = os.path.join(PROJECT_PATH, 'data', 'glucose.db')
-# Создаем директорию для базы данных
-os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-# Настройка базы данных
-engine = create_engine(f'sqlite:///{DB_PATH}?check_same_thread=False')
+def pool_options() -> dict:
+    """
+    Настройки пула соединений: для сервера базы (PostgreSQL) соединения проверяются перед выдачей
+    и пересоздаются через DB_POOL_RECYCLE секунд, чтобы переживать перезапуск сервера и обрывы по простою
+    """
+    options = dict(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    if not IS_SQLITE:
+        options.update(pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+
+# Настройка базы данных (синхронный движок — для миграций и скриптов администрирования)
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={'check_same_thread': False} if IS_SQLITE else {},
+    **({} if IS_SQLITE else pool_options())
+)
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
+# Асинхронный движок для бота: пул соединений, не блокирует event loop
+async_engine = create_async_engine(
+    async_database_url(DATABASE_URL),
+    poolclass=AsyncAdaptedQueuePool,
+    **pool_options()
+)
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL и настройки SQLite: чтения не ждут записи; внешние ключи проверяются, как в PostgreSQL"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA cache_size=-16000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+if IS_SQLITE:
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
+
 class User(Base):
     """Таблица пользователей (клиентов)"""
     __tablename__ = 'users'
@@ -46,10 +100,16 @@ class User(Base):
 
 
 class GlucoseReading(Base):
+    # В PostgreSQL таблица секционирована по timestamp и создаётся миграцией (см. migrate_db.py)
     __tablename__ = 'glucose_readings'
+    __table_args__ = (
+        # Выборки за окно (user_id + диапазон timestamp, сортировка по timestamp)
+        # читаются только из индекса, без обращения к таблице
+        Index('ix_glucose_readings_user_ts', 'user_id', 'timestamp', 'value', 'period'),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.vk_id'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.vk_id'), nullable=False)
     value = Column(Float, nullable=False)
     period = Column(String, nullable=False)
     timestamp = Column(DateTime, default=datetime.now)
@@ -61,6 +121,93 @@ class GlucoseReading(Base):
         return f"<GlucoseReading(user={self.user_id}, value={self.value}, period={self.period})>"
 
 
-# Создание таблиц
-Base.metadata.create_all(engine)
-logger.info("База данных инициализирована")
\ No newline at end of file
+class UserPeriodStats(Base):
+    """Накопительная статистика пользователя по периоду (обновляется при каждом замере)"""
+    __tablename__ = 'user_period_stats'
+
+    user_id = Column(Integer, primary_key=True)
+    period = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    value_sum = Column(Float, nullable=False, default=0.0)
+    value_sum_sq = Column(Float, nullable=False, default=0.0)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    # Замеры в диапазоне 4.0–7.0 и в целевом диапазоне 5.1–7.0 (время в диапазоне, TIR)
+    in_range = Column(Integer, nullable=False, default=0, server_default='0')
+    in_target = Column(Integer, nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+        return f"<UserPeriodStats(user={self.user_id}, period={self.period}, count={self.count})>"
+
+
+class UserValueHistogram(Base):
+    """Число замеров пользователя по периоду и значению с точностью 0.1 (для процентилей)"""
+    __tablename__ = 'user_value_histogram'
+
+    user_id = Column(Integer, primary_key=True)
+    period = Column(String, primary_key=True)
+    tenths = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<UserValueHistogram(user={self.user_id}, period={self.period}, value={self.tenths / 10})>"
+
+
+class DailyActivity(Base):
+    """Активность за день: замеры, активные и новые пользователи (обновляется при записи)"""
+    __tablename__ = 'daily_activity'
+
+    date = Column(Date, primary_key=True)
+    readings = Column(Integer, nullable=False, default=0)
+    active_users = Column(Integer, nullable=False, default=0)
+    new_users = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<DailyActivity(date={self.date}, readings={self.readings}, active={self.active_users})>"
+
+
+class ImportJob(Base):
+    """Загрузка замеров из файла: прогресс по строкам, чтобы продолжить после сбоя"""
+    __tablename__ = 'import_jobs'
+
+    id = Column(Integer, primary_key=True)
+    checksum = Column(String, nullable=False, index=True)
+    source = Column(String, nullable=False)
+    # VK ID из командной строки для файлов без колонки vk_id
+    user_id = Column(Integer)
+    status = Column(String, nullable=False, default='running')
+    rows_done = Column(Integer, nullable=False, default=0)
+    inserted = Column(Integer, nullable=False, default=0)
+    duplicates = Column(Integer, nullable=False, default=0)
+    rejected = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<ImportJob(id={self.id}, source={self.source}, status={self.status}, rows={self.rows_done})>"
+
+
+class CacheVersion(Base):
+    """Версия данных для кэшей процессов бота: меняется, когда данные правит другой процесс"""
+    __tablename__ = 'cache_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<CacheVersion(name={self.name}, version={self.version})>"
+
+
+class ConversationState(Base):
+    """Состояние диалога пользователя (например, ожидание ввода значения)"""
+    __tablename__ = 'conversation_states'
+
+    vk_id = Column(Integer, primary_key=True, autoincrement=False)
+    data = Column(JSON, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<ConversationState(vk_id={self.vk_id}, data={self.data})>"
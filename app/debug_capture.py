@@ -0,0 +1,102 @@
+"""
+Выборочное сохранение отрисованных графиков для отладки
+Выключено по умолчанию; файлы пишет фоновый поток, путь отрисовки только ставит PNG в очередь
+"""
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class DebugCapture:
+    """Сохранение PNG в папку с выборкой, ограничением частоты и хранением последних файлов"""
+
+    def __init__(self, directory: str = None, sample_rate: float = 1.0,
+                 max_per_minute: int = 10, keep: int = 100, queue_size: int = 32):
+        """
+        :param directory: папка для PNG; None — сохранение выключено
+        :param sample_rate: доля графиков, которые сохраняются (0..1)
+        :param max_per_minute: не больше стольких файлов в минуту
+        :param keep: сколько последних файлов хранить в папке
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_per_minute = max_per_minute
+        self.keep = keep
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._window_started = 0.0
+        self._window_count = 0
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.sample_rate > 0
+
+    def capture(self, name: str, png: bytes) -> bool:
+        """Поставить PNG в очередь на сохранение; False — пропущен выборкой или лимитом"""
+        if not self.enabled or random.random() >= self.sample_rate or not self._allow():
+            return False
+        try:
+            self._queue.put_nowait((name, png))
+        except queue.Full:
+            return False
+        self._ensure_started()
+        return True
+
+    def _allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_started >= 60:
+                self._window_started = now
+                self._window_count = 0
+            if self._window_count >= self.max_per_minute:
+                return False
+            self._window_count += 1
+            return True
+
+    def _ensure_started(self):
+        with self._lock:
+            # В процессе-наследнике после fork поток нужно запустить заново
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='debug-capture', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            name, png = self._queue.get()
+            try:
+                stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+                path = os.path.join(self.directory, f"{stamp}_{os.getpid()}_{name}.png")
+                with open(path, 'wb') as f:
+                    f.write(png)
+                self._prune()
+                logger.debug("debug_capture saved path=%s bytes=%d", path, len(png))
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить отладочный график: {e}")
+
+    def _prune(self):
+        files = sorted(entry for entry in os.listdir(self.directory) if entry.endswith('.png'))
+        for entry in files[:max(len(files) - self.keep, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, entry))
+            except OSError:
+                pass
+
+
+_default = None
+
+
+def default_capture() -> DebugCapture:
+    """Сохранение графиков по настройкам DEBUG_PLOT_* из config.py"""
+    global _default
+    if _default is None:
+        from config import DEBUG_PLOT_DIR, DEBUG_PLOT_SAMPLE, DEBUG_PLOT_MAX_PER_MINUTE, DEBUG_PLOT_KEEP
+        _default = DebugCapture(DEBUG_PLOT_DIR, DEBUG_PLOT_SAMPLE, DEBUG_PLOT_MAX_PER_MINUTE, DEBUG_PLOT_KEEP)
+    return _default
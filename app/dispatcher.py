@@ -0,0 +1,83 @@
+"""
+Диспетчер команд: текст сообщения -> обработчик через заранее построенный словарь
+"""
+import logging
+import time
+
+from metrics import Counter, Histogram
+from instrumentation import request_scope
+
+logger = logging.getLogger(__name__)
+
+ROUTE_REQUESTS = Counter('route_requests_total', 'Сообщения по маршрутам', ('route',))
+ROUTE_ERRORS = Counter('route_errors_total', 'Необработанные ошибки по маршрутам', ('route',))
+ROUTE_LATENCY = Histogram('route_latency_seconds', 'Время обработки сообщения по маршрутам', ('route',))
+
+
+def normalize(text: str) -> str:
+    """Ключ маршрута: текст кнопки без пробелов по краям"""
+    return (text or '').strip()
+
+
+class Dispatcher:
+    """Маршрутизация сообщений за O(1) по точному тексту, затем по префиксам, затем fallback"""
+
+    def __init__(self):
+        self._routes = {}
+        self._prefixes = []
+        self._fallback = None
+
+    def route(self, *texts: str):
+        """Зарегистрировать обработчик handler(message) для точных текстов команд"""
+        def decorator(handler):
+            for text in texts:
+                key = normalize(text)
+                if key in self._routes:
+                    raise ValueError(f"Команда '{text}' уже зарегистрирована")
+                self._routes[key] = handler
+            return handler
+        return decorator
+
+    def prefix(self, prefix: str):
+        """Зарегистрировать обработчик handler(message, rest) для текстов с префиксом"""
+        def decorator(handler):
+            self._prefixes.append((normalize(prefix), handler))
+            return handler
+        return decorator
+
+    def fallback(self, handler):
+        """Обработчик всех остальных сообщений (ввод значения, выбор клиента и т.п.)"""
+        self._fallback = handler
+        return handler
+
+    def resolve(self, text: str):
+        """Найти обработчик: (handler, аргументы)"""
+        key = normalize(text)
+
+        handler = self._routes.get(key)
+        if handler is not None:
+            return handler, ()
+
+        for prefix, handler in self._prefixes:
+            if key.startswith(prefix):
+                return handler, (key[len(prefix):],)
+
+        return self._fallback, ()
+
+    async def dispatch(self, message):
+        """Выполнить обработчик сообщения с замером времени и учётом запросов к базе"""
+        handler, args = self.resolve(message.text)
+        if handler is None:
+            return
+
+        route = handler.__name__
+        ROUTE_REQUESTS.inc(route=route)
+        started = time.perf_counter()
+        try:
+            with request_scope(route):
+                await handler(message, *args)
+        except Exception:
+            ROUTE_ERRORS.inc(route=route)
+            raise
+        finally:
+            ROUTE_LATENCY.observe(time.perf_counter() - started, route=route)
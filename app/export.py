@@ -0,0 +1,183 @@
+"""
+Потоковая выгрузка замеров в CSV/XLSX для администраторов
+Замеры читаются из базы (и архива, см. archive.py) порциями и сразу пишутся во временный файл,
+поэтому память не растёт с объёмом истории; выгрузка идёт в отдельном потоке
+openpyxl нужен только для XLSX и импортируется при первой такой выгрузке
+"""
+import asyncio
+import csv
+import logging
+import os
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select
+
+from config import ADMIN_IDS
+from database import engine, User
+from queries import export_readings_query
+from archive import archived_users, iter_archived_readings
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_HEADER = ('vk_id', 'Имя', 'Дата и время', 'Глюкоза, ммоль/л', 'Период')
+# Максимум строк на листе Excel (включая заголовок): дальше — следующий лист
+XLSX_MAX_ROWS = 1_048_576
+
+EXPORT_ROWS = Counter('export_rows_total', 'Выгруженные замеры', ('format',))
+EXPORT_SECONDS = Histogram('export_seconds', 'Время формирования файла выгрузки', ('format',),
+                           buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+
+ExportResult = namedtuple('ExportResult', 'path title rows')
+ExportRow = namedtuple('ExportRow', 'user_id name timestamp value period')
+
+
+def _format_row(row) -> tuple:
+    return row.user_id, row.name, row.timestamp.strftime('%Y-%m-%d %H:%M:%S'), row.value, row.period
+
+
+def write_csv(chunks, path: str) -> int:
+    """Записать порции строк в CSV (UTF-8 с BOM, чтобы Excel открыл кириллицу); :return: число строк"""
+    rows = 0
+    with open(path, 'w', newline='', encoding='utf-8-sig') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(EXPORT_HEADER)
+        for chunk in chunks:
+            writer.writerows(_format_row(row) for row in chunk)
+            rows += len(chunk)
+    return rows
+
+
+def write_xlsx(chunks, path: str) -> int:
+    """Записать порции строк в XLSX в режиме write_only (строки не держатся в памяти); :return: число строк"""
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError("Для выгрузки в XLSX установите openpyxl") from None
+
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = XLSX_MAX_ROWS
+    rows = 0
+    for chunk in chunks:
+        for row in chunk:
+            if sheet_rows >= XLSX_MAX_ROWS:
+                sheet = workbook.create_sheet(f"Замеры {len(workbook.worksheets) + 1}")
+                sheet.append(EXPORT_HEADER)
+                sheet_rows = 1
+            sheet.append((row.user_id, row.name, row.timestamp, row.value, row.period))
+            sheet_rows += 1
+        rows += len(chunk)
+
+    if sheet is None:
+        workbook.create_sheet("Замеры 1").append(EXPORT_HEADER)
+    workbook.save(path)
+    return rows
+
+
+WRITERS = {'csv': write_csv, 'xlsx': write_xlsx}
+
+
+def _archive_chunks(user_id: int, name: str, chunk_size: int):
+    for readings in iter_archived_readings(user_id, chunk_size):
+        yield [ExportRow(user_id, name, reading.timestamp, reading.value, reading.period) for reading in readings]
+
+
+def _admin_ids(connection) -> set:
+    """Администраторы — по ADMIN_IDS и по флагу is_admin, как в списке клиентов"""
+    return set(ADMIN_IDS) | set(connection.scalars(select(User.vk_id).where(User.is_admin.is_(True))))
+
+
+def _with_archive(connection, partitions, user_id: int, chunk_size: int, excluded: set = frozenset()):
+    """
+    Порции замеров из базы, где перед замерами каждого клиента идёт его архив (archive.py):
+    архив старше замеров в базе, поэтому порядок по времени сохраняется
+    """
+    pending = set(archived_users()) - excluded
+    if user_id is not None:
+        pending &= {user_id}
+
+    for chunk in partitions:
+        start = 0
+        for i, row in enumerate(chunk):
+            if row.user_id in pending:
+                pending.discard(row.user_id)
+                if i > start:
+                    yield chunk[start:i]
+                start = i
+                yield from _archive_chunks(row.user_id, row.name, chunk_size)
+        if start < len(chunk):
+            yield chunk[start:]
+
+    # Клиенты, все замеры которых уже в архиве
+    if pending:
+        names = dict(connection.execute(select(User.vk_id, User.name).where(User.vk_id.in_(pending))).all())
+        for archived_user in sorted(pending):
+            yield from _archive_chunks(archived_user, names.get(archived_user, f"User_{archived_user}"), chunk_size)
+
+
+def export_readings(path: str, fmt: str = 'csv', user_id: int = None, chunk_size: int = 5000,
+                    include_admins: bool = False) -> int:
+    """
+    Выгрузить замеры пользователя (или всех) в файл, читая базу порциями по chunk_size строк
+    :param include_admins: при выгрузке всех клиентов добавить и замеры администраторов
+    :return: число выгруженных замеров
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        excluded = _admin_ids(connection) if user_id is None and not include_admins else set()
+        # yield_per: курсор на стороне сервера, в памяти одновременно только одна порция
+        result = connection.execution_options(yield_per=chunk_size).execute(
+            export_readings_query(user_id, excluded)
+        )
+        rows = WRITERS[fmt](_with_archive(connection, result.partitions(), user_id, chunk_size, excluded), path)
+
+    EXPORT_ROWS.inc(rows, format=fmt)
+    EXPORT_SECONDS.observe(time.perf_counter() - started, format=fmt)
+    logger.info(f"Выгружено замеров: {rows} ({fmt}, пользователь {user_id or 'все'})")
+    return rows
+
+
+class ReadingExporter:
+    """Выгрузка замеров в пуле потоков: event loop бота не ждёт базу и запись файла"""
+
+    def __init__(self, workers: int = 1, chunk_size: int = 5000):
+        self.chunk_size = chunk_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export')
+
+    async def export(self, user_id: int = None, fmt: str = 'csv', include_admins: bool = False) -> ExportResult:
+        """
+        Сформировать файл выгрузки во временной папке
+        Файл удаляет вызывающий код после отправки (см. remove)
+        """
+        title = f"glucose_{user_id or 'all'}_{time.strftime('%Y%m%d')}.{fmt}"
+        descriptor, path = tempfile.mkstemp(prefix='export_', suffix=f'.{fmt}')
+        os.close(descriptor)
+
+        loop = asyncio.get_running_loop()
+        try:
+            rows = await loop.run_in_executor(
+                self._executor, export_readings, path, fmt, user_id, self.chunk_size, include_admins
+            )
+        except BaseException:
+            self.remove(path)
+            raise
+        return ExportResult(path, title, rows)
+
+    @staticmethod
+    def remove(path: str):
+        """Удалить временный файл выгрузки"""
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить файл выгрузки {path}: {e}")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -2,24 +2,30 @@
 Скрипт для просмотра и исправления пользователей в базе данных
 """
 from database import Session, User
+from cache import USER_CACHE_VERSION
+from queries import clients_overview_query, cache_version_bump
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def bump_user_cache_version(session):
+    """Сообщить работающему боту (всем его процессам), что профили изменились: кэш профилей будет сброшен"""
+    session.execute(cache_version_bump(USER_CACHE_VERSION))
+
+
 def list_all_users():
     """Показать всех пользователей"""
     session = Session()
-    users = session.query(User).all()
+    users = session.execute(clients_overview_query(include_admins=True).order_by(User.id)).all()
 
     print("\n" + "=" * 80)
     print(f"{'ID':<5} {'VK ID':<15} {'Имя':<30} {'Админ':<8} {'Замеры':<8}")
     print("=" * 80)
 
     for user in users:
-        readings_count = len(user.readings)
-        print(f"{user.id:<5} {user.vk_id:<15} {user.name:<30} {user.is_admin:<8} {readings_count:<8}")
+        print(f"{user.id:<5} {user.vk_id:<15} {user.name:<30} {user.is_admin:<8} {user.readings:<8}")
 
     print("=" * 80)
     print(f"Всего пользователей: {len(users)}")
@@ -34,6 +40,7 @@ def fix_user_name(vk_id: int, new_name: str):
     if user:
         old_name = user.name
         user.name = new_name
+        bump_user_cache_version(session)
         session.commit()
         print(f"Имя пользователя {vk_id} изменено с '{old_name}' на '{new_name}'")
     else:
@@ -49,6 +56,7 @@ def set_admin(vk_id: int, is_admin: bool = True):
 
     if user:
         user.is_admin = is_admin
+        bump_user_cache_version(session)
         session.commit()
         print(f"Пользователь {user.name} теперь {'администратор' if is_admin else 'обычный пользователь'}")
     else:
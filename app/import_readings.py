@@ -0,0 +1,437 @@
+"""
+Загрузка истории замеров из CSV (выгрузки бота, дневники, программы глюкометров)
+Файл читается построчно, строки проверяются (диапазон 1.0–30.0, названия периодов)
+и вставляются порциями: каждая порция — отдельная транзакция вместе с приростом статистики,
+дневной активности и прогрессом в import_jobs, поэтому после сбоя загрузка того же файла
+продолжается с места остановки, а накопительные таблицы остаются согласованными.
+Дубли уже сохранённых замеров (в том числе в архиве) пропускаются
+"""
+import codecs
+import csv
+import hashlib
+import logging
+import os
+import tempfile
+from collections import namedtuple
+from datetime import datetime, timedelta
+from operator import itemgetter, methodcaller
+from itertools import islice
+
+from sqlalchemy import select, insert, update
+
+from config import IMPORT_CHUNK_SIZE, ADMIN_IDS
+from database import engine, Session, User, GlucoseReading, ImportJob, ensure_database_dir
+from queries import (
+    existing_readings_query, period_stats_upsert, period_stats_params, readings_stats_deltas,
+    histogram_upsert, histogram_params, readings_histogram_deltas,
+    daily_activity_upsert, daily_activity_params, readings_activity_deltas, user_insert_missing
+)
+from renderer import ALL_PERIODS
+from archive import load_archive, ArchivedKeys
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Допустимые значения, как при вводе через бота
+VALUE_RANGE = (1.0, 30.0)
+
+# Названия колонок (без учёта регистра), в том числе из выгрузки бота
+COLUMN_ALIASES = {
+    'user_id': ('vk_id', 'user_id'),
+    'timestamp': ('timestamp', 'datetime', 'дата и время', 'date', 'дата'),
+    'time': ('time', 'время'),
+    'value': ('value', 'glucose', 'глюкоза, ммоль/л', 'глюкоза', 'ммоль/л', 'mmol/l'),
+    'period': ('period', 'период'),
+}
+TIMESTAMP_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y', '%d/%m/%Y %H:%M', '%Y/%m/%d %H:%M')
+PERIODS = {period.lower(): period for period in ALL_PERIODS}
+DELIMITERS = (';', '\t', ',')
+READING_COLUMNS = ('user_id', 'timestamp', 'value', 'period')
+
+# Сколько отклонённых строк показать в логе и в ответе
+MAX_REPORTED_ERRORS = 10
+
+IMPORT_ROWS = Counter('import_rows_total', 'Строки загружаемых файлов по результату', ('result',))
+
+ImportResult = namedtuple('ImportResult', 'job_id status inserted duplicates rejected user_ids errors')
+ImportedReading = namedtuple('ImportedReading', READING_COLUMNS)
+
+
+class ImportFileError(ValueError):
+    """Файл нельзя загрузить (нет нужных колонок, не указан VK ID и т.п.)"""
+
+
+class ImportInterrupted(RuntimeError):
+    """Загрузка прервана сбоем (база, диск); повторная загрузка того же файла продолжит её"""
+
+    def __init__(self, job_id: int, error: Exception):
+        super().__init__(f"Загрузка #{job_id} прервана: {error}")
+        self.job_id = job_id
+
+
+def file_checksum(path: str) -> str:
+    """SHA-256 файла: по нему находится незавершённая загрузка того же файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def detect_encoding(path: str) -> str:
+    """UTF-8 (с BOM или без) или cp1251 — кодировка русских версий Excel и программ глюкометров"""
+    with open(path, 'rb') as file:
+        head = file.read(1 << 16)
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Блок мог оборваться посреди символа — это не признак другой кодировки
+        if e.start < len(head) - 3:
+            return 'cp1251'
+    return 'utf-8'
+
+
+def parse_timestamp(text: str) -> datetime:
+    text = text.strip()
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"неизвестный формат даты '{text}'")
+
+
+def parse_value(text: str) -> float:
+    try:
+        value = float(text.strip().replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"значение '{text}' не число") from None
+    if not VALUE_RANGE[0] <= value <= VALUE_RANGE[1]:
+        raise ValueError(f"значение {value} вне диапазона {VALUE_RANGE[0]}–{VALUE_RANGE[1]}")
+    return value
+
+
+def parse_period(text: str) -> str:
+    """Название периода, как в боте; текст кнопки с эмодзи тоже подходит"""
+    key = text.strip().lower()
+    period = PERIODS.get(key)
+    if period is None and ' ' in key:
+        period = PERIODS.get(key.split(' ', 1)[1])
+    if period is None:
+        raise ValueError(f"неизвестный период '{text}'")
+    return period
+
+
+def _columns(header) -> dict:
+    """Номера колонок по заголовку файла"""
+    names = [name.strip().lower() for name in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in names:
+                columns[field] = names.index(alias)
+                break
+    missing = {'timestamp', 'value', 'period'} - set(columns)
+    if missing:
+        raise ImportFileError(f"В файле нет колонок: {', '.join(sorted(missing))}")
+    return columns
+
+
+def read_rows(path: str, user_id: int = None):
+    """
+    Построчно разобрать файл
+    :return: генератор (номер строки, замер ImportedReading или None, ошибка)
+    """
+    with open(path, newline='', encoding=detect_encoding(path)) as file:
+        header = file.readline()
+        # «;» — разделитель русского Excel и выгрузки бота: запятая может быть внутри названий колонок
+        delimiter = next((d for d in DELIMITERS if d in header), None)
+        if delimiter is None:
+            raise ImportFileError("Не удалось определить разделитель колонок (нужен CSV с заголовком)")
+        reader = csv.reader(file, delimiter=delimiter)
+        columns = _columns(next(csv.reader([header], delimiter=delimiter)))
+        if user_id is None and 'user_id' not in columns:
+            raise ImportFileError("В файле нет колонки vk_id — укажите VK ID клиента")
+
+        user_column = columns.get('user_id')
+        time_column = columns.get('time')
+        timestamp_column, value_column, period_column = columns['timestamp'], columns['value'], columns['period']
+        for line, row in enumerate(reader, start=2):
+            if not any(row):
+                continue
+            try:
+                stamp = row[timestamp_column]
+                if time_column is not None:
+                    stamp = f"{stamp} {row[time_column]}"
+                reading = ImportedReading(
+                    user_id if user_id is not None else int(row[user_column]),
+                    parse_timestamp(stamp),
+                    parse_value(row[value_column]),
+                    parse_period(row[period_column])
+                )
+            except (ValueError, IndexError) as e:
+                yield line, None, f"строка {line}: {e if isinstance(e, ValueError) else 'не хватает колонок'}"
+                continue
+            yield line, reading, None
+
+
+def _archived_keys(archives: dict, user_id: int):
+    """Замеры клиента в архиве (загружаются один раз за загрузку файла); без архива — пустой кортеж"""
+    keys = archives.get(user_id)
+    if keys is None:
+        archive = load_archive(user_id)
+        keys = archives[user_id] = ArchivedKeys(archive) if archive is not None else ()
+    return keys
+
+
+def _fresh_readings(connection, readings, archives: dict) -> tuple:
+    """
+    Замеры порции без дублей внутри порции, среди уже сохранённых и в архиве
+    Выгрузка и дневники хранят время с точностью до секунды, поэтому и сравнивается оно по секундам
+    :return: (новые замеры, пары (user_id, date), в которые у клиента уже были замеры — для дневной активности)
+    """
+    fresh = list(dict.fromkeys(readings))
+    if not fresh:
+        return fresh, set()
+    fresh = [reading for reading in fresh if reading[1:] not in _archived_keys(archives, reading[0])]
+    if not fresh:
+        return fresh, set()
+
+    # Замеры в базе читаются за целые дни: по ним же видно, был ли клиент активен в день замера
+    user_ids = {reading.user_id for reading in fresh}
+    first_day = min(reading.timestamp for reading in fresh).date()
+    last_day = max(reading.timestamp for reading in fresh).date()
+    since = datetime.combine(first_day, datetime.min.time())
+    until = datetime.combine(last_day + timedelta(days=1), datetime.min.time())
+    existing = set()
+    known_days = set()
+    for user_id, timestamp, value, period in connection.execute(existing_readings_query(user_ids, since, until)):
+        existing.add((user_id, timestamp.replace(microsecond=0), value, period))
+        known_days.add((user_id, timestamp.date()))
+    for user_id, day in {(reading.user_id, reading.timestamp.date()) for reading in fresh}:
+        keys = _archived_keys(archives, user_id)
+        if keys and keys.has_day(day):
+            known_days.add((user_id, day))
+
+    if existing:
+        fresh = [reading for reading in fresh
+                 if (reading[0], reading[1].replace(microsecond=0), reading[2], reading[3]) not in existing]
+    return fresh, known_days
+
+
+def _insert_readings(connection, readings):
+    """
+    executemany драйвера без обработки параметров SQLAlchemy по каждой строке;
+    время записывается в том же виде, что и через модели
+    """
+    dialect = connection.dialect
+    compiled = insert(GlucoseReading).compile(dialect=dialect, column_keys=READING_COLUMNS)
+    if dialect.name == 'sqlite':
+        # Формат DateTime SQLAlchemy для SQLite, но isoformat в разы быстрее его bind-процессора
+        to_timestamp = methodcaller('isoformat', ' ', 'microseconds')
+    else:
+        timestamp_type = GlucoseReading.__table__.c.timestamp.type.dialect_impl(dialect)
+        to_timestamp = timestamp_type.bind_processor(dialect) or (lambda value: value)
+
+    rows = ((user_id, to_timestamp(timestamp), value, period) for user_id, timestamp, value, period in readings)
+    if compiled.positional:
+        order = itemgetter(*(READING_COLUMNS.index(name) for name in compiled.positiontup))
+        params = [order(row) for row in rows]
+    else:
+        params = [dict(zip(READING_COLUMNS, row)) for row in rows]
+    connection.exec_driver_sql(compiled.string, params)
+
+
+def _ensure_users(connection, user_ids) -> int:
+    """
+    Создать пользователей, которых ещё нет в базе, так же, как бот при сохранении замера:
+    с именем по умолчанию, ON CONFLICT DO NOTHING — бот может создать того же пользователя параллельно
+    :return: число созданных пользователей
+    """
+    known = set(connection.scalars(select(User.vk_id).where(User.vk_id.in_(user_ids))))
+    created = []
+    for vk_id in sorted(set(user_ids) - known):
+        result = connection.execute(user_insert_missing(vk_id, f"User_{vk_id}", vk_id in ADMIN_IDS))
+        if result.first() is not None:
+            created.append(vk_id)
+    if created:
+        logger.info(f"Созданы пользователи: {', '.join(map(str, created))}")
+    return len(created)
+
+
+def _apply_aggregates(connection, fresh, known_days: set, new_users: int):
+    """
+    Добавить новые замеры порции к статистике, гистограмме и дневной активности (в транзакции порции)
+    Стоимость пропорциональна порции, а не всей таблице замеров
+    """
+    activity = readings_activity_deltas(fresh, known_days=known_days)
+    if new_users:
+        activity.setdefault(datetime.now().date(), {})['new_users'] = new_users
+
+    connection.execute(period_stats_upsert(), period_stats_params(readings_stats_deltas(fresh)))
+    connection.execute(histogram_upsert(), histogram_params(readings_histogram_deltas(fresh)))
+    connection.execute(daily_activity_upsert(), daily_activity_params(activity))
+
+
+def _start_job(path: str, source: str, user_id: int) -> ImportJob:
+    """Незавершённая (или уже завершённая) загрузка этого файла либо новая"""
+    checksum = file_checksum(path)
+    same_user = ImportJob.user_id.is_(None) if user_id is None else ImportJob.user_id == user_id
+    with Session() as session:
+        job = session.scalars(
+            select(ImportJob).where(ImportJob.checksum == checksum, same_user).order_by(ImportJob.id.desc())
+        ).first()
+        if job is None:
+            job = ImportJob(checksum=checksum, source=source, user_id=user_id)
+            session.add(job)
+        elif job.status != 'done':
+            logger.info(f"Продолжение загрузки #{job.id} со строки {job.rows_done + 1}")
+            job.status = 'running'
+            job.error = None
+        session.commit()
+        session.refresh(job)
+        session.expunge(job)
+        return job
+
+
+def _finish_job(job_id: int, **values):
+    with engine.begin() as connection:
+        connection.execute(update(ImportJob).where(ImportJob.id == job_id)
+                           .values(updated_at=datetime.now(), **values))
+
+
+def import_readings(path: str, user_id: int = None, source: str = None,
+                    chunk_size: int = IMPORT_CHUNK_SIZE) -> ImportResult:
+    """
+    Загрузить замеры из файла
+    :param user_id: VK ID клиента для файлов без колонки vk_id (перекрывает колонку, если она есть)
+    :param source: название файла для import_jobs (по умолчанию — путь)
+    """
+    job = _start_job(path, source or path, user_id)
+    if job.status == 'done':
+        logger.info(f"Файл уже загружен (#{job.id})")
+        return ImportResult(job.id, 'already', 0, 0, 0, set(), [])
+
+    rows = read_rows(path, user_id)
+    archives = {}
+    user_ids = set()
+    errors = []
+    inserted = duplicates = rejected = 0
+    try:
+        # Строки, загруженные до сбоя, только разбираются: нужен список затронутых пользователей
+        for _, reading, _ in islice(rows, job.rows_done):
+            if reading is not None:
+                user_ids.add(reading[0])
+
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            readings = [reading for _, reading, _ in chunk if reading is not None]
+            chunk_errors = [error for _, _, error in chunk if error is not None]
+            chunk_users = {reading[0] for reading in readings}
+
+            # Порция, её агрегаты и прогресс фиксируются одной транзакцией: после сбоя порция не задвоится
+            with engine.begin() as connection:
+                fresh, known_days = _fresh_readings(connection, readings, archives)
+                if fresh:
+                    new_users = _ensure_users(connection, {reading.user_id for reading in fresh})
+                    _insert_readings(connection, fresh)
+                    _apply_aggregates(connection, fresh, known_days, new_users)
+                connection.execute(
+                    update(ImportJob).where(ImportJob.id == job.id).values(
+                        rows_done=ImportJob.rows_done + len(chunk),
+                        inserted=ImportJob.inserted + len(fresh),
+                        duplicates=ImportJob.duplicates + len(readings) - len(fresh),
+                        rejected=ImportJob.rejected + len(chunk_errors),
+                        updated_at=datetime.now()
+                    )
+                )
+
+            user_ids |= chunk_users
+            inserted += len(fresh)
+            duplicates += len(readings) - len(fresh)
+            rejected += len(chunk_errors)
+            for error in chunk_errors:
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(error)
+                    logger.warning(f"Пропущена {error}")
+            IMPORT_ROWS.inc(len(fresh), result='inserted')
+            IMPORT_ROWS.inc(len(readings) - len(fresh), result='duplicate')
+            IMPORT_ROWS.inc(len(chunk_errors), result='rejected')
+    except Exception as e:
+        _finish_job(job.id, status='failed', error=str(e)[:500])
+        logger.error(f"Загрузка #{job.id} прервана: {e}")
+        if isinstance(e, ImportFileError):
+            raise
+        raise ImportInterrupted(job.id, e) from e
+
+    _finish_job(job.id, status='done')
+    logger.info(f"Загрузка #{job.id} завершена: добавлено {inserted}, дублей {duplicates}, отклонено {rejected}")
+    return ImportResult(job.id, 'done', inserted, duplicates, rejected, user_ids, errors)
+
+
+async def download_document(url: str, max_bytes: int) -> str:
+    """Скачать документ VK во временный файл частями; :return: путь к файлу"""
+    from aiohttp import ClientSession
+
+    descriptor, path = tempfile.mkstemp(prefix='import_', suffix='.csv')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            async with ClientSession() as session, session.get(url) as response:
+                response.raise_for_status()
+                size = 0
+                async for block in response.content.iter_chunked(1 << 16):
+                    size += len(block)
+                    if size > max_bytes:
+                        raise ImportFileError(f"Файл больше {max_bytes / (1 << 20):g} МБ")
+                    file.write(block)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def list_jobs(limit: int = 20):
+    """Показать последние загрузки"""
+    with Session() as session:
+        jobs = session.scalars(select(ImportJob).order_by(ImportJob.id.desc()).limit(limit)).all()
+
+    print(f"{'#':<5} {'Статус':<9} {'Строк':<9} {'Добавлено':<10} {'Дублей':<8} {'Ошибок':<7} Файл")
+    for job in jobs:
+        print(f"{job.id:<5} {job.status:<9} {job.rows_done:<9} {job.inserted:<10} "
+              f"{job.duplicates:<8} {job.rejected:<7} {job.source}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) == 2 and sys.argv[1] == "jobs":
+        list_jobs()
+    elif len(sys.argv) in (2, 3) and sys.argv[1] not in ("-h", "--help"):
+        # import_readings.py history.csv [VK_ID]
+        ensure_database_dir()
+        try:
+            result = import_readings(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else None)
+        except ImportFileError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        except ImportInterrupted as e:
+            print(f"❌ {e}. Запустите загрузку того же файла ещё раз — она продолжится с места остановки")
+            sys.exit(1)
+        if result.status == 'already':
+            print(f"Файл уже загружен (#{result.job_id})")
+        else:
+            print(f"Добавлено: {result.inserted}, дублей: {result.duplicates}, отклонено: {result.rejected}")
+    else:
+        print("Использование:")
+        print("  python import_readings.py ФАЙЛ.csv [VK_ID] - загрузить замеры (VK_ID — если в файле нет vk_id)")
+        print("  python import_readings.py jobs             - показать последние загрузки")
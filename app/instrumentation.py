@@ -0,0 +1,110 @@
+"""
+Инструментирование горячих путей бота
+Время и число запросов к базе на каждое сообщение (видно N+1 по маршрутам)
+и HTTP-эндпоинт /metrics в текстовом формате Prometheus
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from metrics import Counter, Histogram, render_text
+
+logger = logging.getLogger(__name__)
+
+DB_QUERIES = Counter('db_queries_total', 'Запросы к базе', ('route',))
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Время одного запроса к базе', ('route',))
+DB_QUERIES_PER_MESSAGE = Histogram(
+    'db_queries_per_message', 'Запросов к базе на одно сообщение', ('route',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+DB_SECONDS_PER_MESSAGE = Histogram('db_seconds_per_message', 'Время в базе на одно сообщение', ('route',))
+
+# Запросы вне обработки сообщения (фоновая запись, очистка состояний)
+BACKGROUND_ROUTE = 'background'
+
+
+class RequestScope:
+    """Счётчики одного сообщения"""
+    __slots__ = ('route', 'queries', 'db_seconds')
+
+    def __init__(self, route: str):
+        self.route = route
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+_current_scope = contextvars.ContextVar('request_scope', default=None)
+
+
+@contextmanager
+def request_scope(route: str):
+    """Учитывать запросы к базе внутри блока за маршрутом route"""
+    scope = RequestScope(route)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        DB_QUERIES_PER_MESSAGE.observe(scope.queries, route=route)
+        DB_SECONDS_PER_MESSAGE.observe(scope.db_seconds, route=route)
+
+
+def background_task(coro):
+    """
+    Запустить фоновую задачу в пустом контексте: create_task копирует контекст обработчика,
+    и без этого запросы задачи учитывались бы за маршрутом сообщения, которое её запустило
+    """
+    return asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    scope = _current_scope.get()
+    route = scope.route if scope else BACKGROUND_ROUTE
+    if scope:
+        scope.queries += 1
+        scope.db_seconds += elapsed
+    DB_QUERIES.inc(route=route)
+    DB_QUERY_SECONDS.observe(elapsed, route=route)
+
+
+def _handle_error(context):
+    # Запрос завершился ошибкой: after_cursor_execute не вызывается, время начала снимаем здесь
+    connection = context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def instrument_engine(engine):
+    """Подключить учёт запросов к движку SQLAlchemy (синхронному или асинхронному)"""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+    event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(sync_engine, 'handle_error', _handle_error)
+
+
+async def start_metrics_server(port: int, host: str = '127.0.0.1'):
+    """Запустить HTTP-эндпоинт /metrics в текущем event loop"""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(
+            body=render_text().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,106 @@
+"""
+Клавиатуры бота
+Постоянные клавиатуры собираются в JSON один раз при запуске
+"""
+from vkbottle import Keyboard, KeyboardButtonColor, Text
+
+from repository import is_admin
+
+# Ограничения VK для обычной (не inline) клавиатуры
+MAX_ROWS = 10
+MAX_LABEL_LENGTH = 40
+
+# На странице списка клиентов: по клиенту в строке и строка навигации
+CLIENTS_PAGE_SIZE = MAX_ROWS - 1
+CLIENTS_PAGE_PREFIX = "👥 Клиенты, стр. "
+
+# Выгрузка замеров: «📤 Экспорт [VK_ID] [csv|xlsx]», без VK ID — все клиенты
+EXPORT_PREFIX = "📤 Экспорт"
+# Слово в команде выгрузки: выгрузить всех вместе с замерами администраторов
+EXPORT_ADMINS_OPTION = "админы"
+# Загрузка истории: CSV-документ с подписью «📥 Импорт [VK_ID]»
+IMPORT_PREFIX = "📥 Импорт"
+
+
+def create_main_keyboard():
+    """Создание основной клавиатуры с кнопками"""
+    keyboard = Keyboard(one_time=False, inline=False)
+
+    # Первый ряд
+    keyboard.add(Text("🍽 Перед завтраком"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.add(Text("🍽 Перед обедом"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.add(Text("🍽 Перед ужином"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.row()
+
+    # Второй ряд
+    keyboard.add(Text("🌙 Перед сном"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.add(Text("🌃 Ночью"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.row()
+
+    # Третий ряд
+    keyboard.add(Text("⏱ Через час после еды"), color=KeyboardButtonColor.POSITIVE)
+    keyboard.add(Text("📊 График"), color=KeyboardButtonColor.SECONDARY)
+    keyboard.add(Text("📊 Моя статистика"), color=KeyboardButtonColor.SECONDARY)
+    keyboard.row()
+    keyboard.add(Text("📅 За неделю"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.add(Text("📅 За месяц"), color=KeyboardButtonColor.PRIMARY)
+
+    return keyboard
+
+
+def create_admin_keyboard():
+    """Клавиатура для администратора"""
+    keyboard = create_main_keyboard()
+    keyboard.row()
+    keyboard.add(Text("👥 Список клиентов"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.add(Text("📊 Админ панель"), color=KeyboardButtonColor.SECONDARY)
+    return keyboard
+
+
+def create_admin_panel_keyboard():
+    """Клавиатура админ панели"""
+    keyboard = Keyboard(inline=False)
+    keyboard.add(Text("👥 Список клиентов"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.row()
+    keyboard.add(Text("📊 Общая статистика"), color=KeyboardButtonColor.PRIMARY)
+    keyboard.row()
+    keyboard.add(Text(EXPORT_PREFIX), color=KeyboardButtonColor.SECONDARY)
+    keyboard.add(Text(IMPORT_PREFIX), color=KeyboardButtonColor.SECONDARY)
+    keyboard.row()
+    keyboard.add(Text("🔙 Назад"), color=KeyboardButtonColor.SECONDARY)
+    return keyboard
+
+
+# Готовый JSON постоянных клавиатур (строки неизменяемы, их можно отдавать в любой ответ)
+MAIN_KEYBOARD = create_main_keyboard().get_json()
+ADMIN_KEYBOARD = create_admin_keyboard().get_json()
+ADMIN_PANEL_KEYBOARD = create_admin_panel_keyboard().get_json()
+
+
+async def keyboard_for(vk_id: int) -> str:
+    """Главная клавиатура пользователя с учётом прав (флаг администратора берётся из кэша)"""
+    return ADMIN_KEYBOARD if await is_admin(vk_id) else MAIN_KEYBOARD
+
+
+def clients_keyboard(clients, page: int, has_next: bool) -> str:
+    """
+    Страница списка клиентов: по клиенту в строке, внизу навигация и «Назад»
+    Укладывается в лимит VK на число строк при любом количестве клиентов
+    """
+    keyboard = Keyboard(one_time=True, inline=False)
+
+    for client in clients:
+        suffix = f" ({client.readings} зап.)"
+        label = f"{client.vk_id}:{client.name}"
+        if len(label) + len(suffix) > MAX_LABEL_LENGTH:
+            label = label[:MAX_LABEL_LENGTH - len(suffix) - 1] + "…"
+        keyboard.add(Text(label + suffix), color=KeyboardButtonColor.PRIMARY)
+        keyboard.row()
+
+    if page > 1:
+        keyboard.add(Text(f"{CLIENTS_PAGE_PREFIX}{page - 1}"), color=KeyboardButtonColor.SECONDARY)
+    keyboard.add(Text("🔙 Назад"), color=KeyboardButtonColor.SECONDARY)
+    if has_next:
+        keyboard.add(Text(f"{CLIENTS_PAGE_PREFIX}{page + 1}"), color=KeyboardButtonColor.SECONDARY)
+
+    return keyboard.get_json()
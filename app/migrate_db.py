@@ -1,20 +1,76 @@
 """
 Скрипт для миграции существующей базы данных
-Добавляет таблицу users и переносит существующих пользователей
+Добавляет таблицу users и переносит существующих пользователей,
+создаёт индексы и пересчитывает накопительную статистику user_period_stats, user_value_histogram
+и дневную активность daily_activity; в PostgreSQL создаёт glucose_readings, секционированную по годам
 """
-from database import Session, engine, Base, User, GlucoseReading
+from datetime import datetime
+
+from sqlalchemy import text, inspect
+from sqlalchemy.schema import CreateColumn
+
+from config import PARTITION_YEARS_AHEAD
+from database import Session, engine, Base, User, GlucoseReading, ensure_database_dir, IS_POSTGRESQL
+from queries import rebuild_period_stats_statements, rebuild_daily_activity_statements
+from archive import apply_archive_stats, apply_archive_activity
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def create_schema(rebuild: bool = True):
+    """
+    Создать недостающие таблицы и колонки (быстро, можно запускать при каждом старте)
+    :param rebuild: пересчитать накопительную статистику, если её таблицы или колонки только что созданы
+    """
+    ensure_database_dir()
+    inspector = inspect(engine)
+    stats_missing = not all(inspector.has_table(table) for table in ('user_period_stats', 'user_value_histogram'))
+    activity_missing = not inspector.has_table('daily_activity')
+    if IS_POSTGRESQL and not inspector.has_table(GlucoseReading.__tablename__):
+        create_partitioned_readings()
+    Base.metadata.create_all(engine)
+    if IS_POSTGRESQL:
+        ensure_reading_partitions()
+    logger.info("Таблицы созданы")
+
+    changed = add_missing_columns() or stats_missing
+    if changed and rebuild:
+        # Новые накопительные счётчики заполняются пересчётом по замерам
+        rebuild_period_stats()
+    if activity_missing and rebuild:
+        rebuild_daily_activity()
+
+
+def add_missing_columns() -> bool:
+    """Добавить в существующие таблицы колонки, появившиеся в моделях; True — что-то добавлено"""
+    inspector = inspect(engine)
+    added = False
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+                not_null = " NOT NULL" if not column.nullable and default else ""
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{not_null}{default}"
+                ))
+                logger.info(f"Добавлена колонка {table.name}.{column.name}")
+                added = True
+    return added
+
+
 def migrate():
     """Миграция существующих пользователей"""
 
-    # Создаем новые таблицы
-    Base.metadata.create_all(engine)
-    logger.info("Таблицы созданы")
+    # Создаем новые таблицы (статистика пересчитывается в конце миграции)
+    create_schema(rebuild=False)
 
     session = Session()
 
@@ -33,8 +89,146 @@ def migrate():
     session.commit()
     session.close()
 
+    create_indexes()
+    rebuild_period_stats()
+    rebuild_daily_activity()
+
     logger.info("Миграция завершена")
 
 
+def create_indexes():
+    """Создать составной индекс (user_id, timestamp) и удалить старый индекс по user_id"""
+    # checkfirst: миграцию можно запускать повторно на работающей базе
+    with engine.begin() as connection:
+        for index in GlucoseReading.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        connection.execute(text("DROP INDEX IF EXISTS ix_glucose_readings_user_id"))
+        connection.execute(text("ANALYZE glucose_readings"))
+
+    logger.info("Индексы glucose_readings созданы")
+
+
+def create_partitioned_readings():
+    """
+    PostgreSQL: создать glucose_readings, секционированную по диапазонам timestamp
+    Ключ секционирования должен входить в первичный ключ, поэтому он (id, timestamp);
+    замеры вне созданных секций попадают в секцию по умолчанию
+    """
+    table = GlucoseReading.__table__
+    columns = ",\n".join(f"    {CreateColumn(column).compile(engine)}" for column in table.columns)
+    with engine.begin() as connection:
+        User.__table__.create(connection, checkfirst=True)
+        connection.execute(text(
+            f"CREATE TABLE {table.name} (\n{columns},\n"
+            f"    PRIMARY KEY (id, timestamp),\n"
+            f"    FOREIGN KEY (user_id) REFERENCES users (vk_id)\n"
+            f") PARTITION BY RANGE (timestamp)"
+        ))
+        connection.execute(text(f"CREATE TABLE {table.name}_default PARTITION OF {table.name} DEFAULT"))
+        # Индекс секционированной таблицы создаётся и на каждой секции
+        for index in table.indexes:
+            index.create(connection)
+
+    logger.info("Создана секционированная таблица glucose_readings")
+
+
+def _reading_partitions(connection) -> set:
+    """Имена секций glucose_readings"""
+    return set(connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = :table"
+    ), {'table': GlucoseReading.__tablename__}).scalars())
+
+
+def ensure_reading_partitions(years_ahead: int = PARTITION_YEARS_AHEAD, split_default: bool = False):
+    """
+    PostgreSQL: создать секции glucose_readings по годам, с текущего на years_ahead лет вперёд
+    :param split_default: вынести в свои секции и годы, замеры которых лежат в секции по умолчанию
+        (например, после загрузки старой истории из файла)
+    """
+    if not IS_POSTGRESQL:
+        logger.info("Секции замеров есть только в PostgreSQL")
+        return
+
+    table = GlucoseReading.__tablename__
+    default = f"{table}_default"
+    with engine.begin() as connection:
+        partitions = _reading_partitions(connection)
+        if default not in partitions:
+            # Таблица создана до перехода на секции — оставляем как есть
+            logger.warning("glucose_readings не секционирована, секции не создаются")
+            return
+
+        year = datetime.now().year
+        years = set(range(year, year + years_ahead + 1))
+        if split_default:
+            years.update(connection.execute(text(
+                f"SELECT DISTINCT CAST(date_part('year', timestamp) AS INTEGER) FROM {default}"
+            )).scalars())
+
+        for partition_year in sorted(years):
+            name = f"{table}_y{partition_year}"
+            if name in partitions:
+                continue
+            start, end = datetime(partition_year, 1, 1), datetime(partition_year + 1, 1, 1)
+            # Замеры этого года переносятся из секции по умолчанию до подключения новой секции:
+            # иначе PostgreSQL не даст создать секцию, пересекающуюся со строками секции по умолчанию
+            connection.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+            connection.execute(text(
+                f"WITH moved AS (DELETE FROM {default} WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"
+            ), {'start': start, 'end': end})
+            connection.execute(text(
+                f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{start.date()}') TO ('{end.date()}')"
+            ))
+            logger.info(f"Создана секция {name}")
+
+
+def rebuild_period_stats(user_id: int = None):
+    """Пересчитать user_period_stats и user_value_histogram по всем замерам и архиву (или по одному пользователю)"""
+    with engine.begin() as connection:
+        for statement in rebuild_period_stats_statements(user_id):
+            connection.execute(statement)
+        # Замеры, перенесённые в архив, в glucose_readings уже нет
+        apply_archive_stats(connection, user_id)
+
+    logger.info(f"Статистика пересчитана{f' для пользователя {user_id}' if user_id else ''}")
+
+
+def rebuild_daily_activity():
+    """Пересчитать daily_activity по всем замерам, архиву и датам регистрации пользователей"""
+    with engine.begin() as connection:
+        for statement in rebuild_daily_activity_statements():
+            connection.execute(statement)
+        apply_archive_activity(connection)
+
+    logger.info("Дневная активность пересчитана")
+
+
 if __name__ == "__main__":
-    migrate()
\ No newline at end of file
+    import sys
+
+    if len(sys.argv) == 1:
+        migrate()
+    elif sys.argv[1] == "schema":
+        create_schema()
+    elif sys.argv[1] == "indexes":
+        create_indexes()
+    elif sys.argv[1] == "rebuild-stats":
+        # rebuild-stats [VK_ID]
+        rebuild_period_stats(int(sys.argv[2]) if len(sys.argv) == 3 else None)
+    elif sys.argv[1] == "rebuild-activity":
+        rebuild_daily_activity()
+    elif sys.argv[1] == "partitions":
+        ensure_reading_partitions(split_default=True)
+    else:
+        print("Использование:")
+        print("  python migrate_db.py                        - миграция базы данных")
+        print("  python migrate_db.py schema                 - создать недостающие таблицы")
+        print("  python migrate_db.py indexes                - создать индексы glucose_readings")
+        print("  python migrate_db.py rebuild-stats [VK_ID]  - пересчитать статистику по замерам")
+        print("  python migrate_db.py rebuild-activity       - пересчитать дневную активность")
+        print("  python migrate_db.py partitions             - PostgreSQL: создать секции замеров по годам")
\ No newline at end of file
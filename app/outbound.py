@@ -0,0 +1,198 @@
+"""
+Исходящие запросы к VK API
+Ответы ставятся в очередь и отправляются с ограничением частоты (token bucket),
+запросы users.get объединяются в пачки, временные ошибки повторяются с нарастающей паузой
+"""
+import asyncio
+import logging
+import random
+import time
+
+from aiohttp import ClientError
+from vkbottle import VKAPIError
+
+from metrics import Counter, Gauge, Histogram
+from instrumentation import background_task
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_QUEUE_DEPTH = Gauge('outbound_queue_depth', 'Сообщения в очереди на отправку')
+OUTBOUND_SEND_SECONDS = Histogram('outbound_send_seconds', 'Время от постановки в очередь до отправки', ('method',))
+OUTBOUND_RETRIES = Counter('outbound_retries_total', 'Повторы запросов к VK API', ('method',))
+OUTBOUND_FAILURES = Counter('outbound_failures_total', 'Запросы к VK API, не выполненные после всех попыток', ('method',))
+USERS_GET_BATCH = Histogram(
+    'users_get_batch_size', 'VK ID в одном запросе users.get',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 1000)
+)
+
+# Коды ошибок VK, после которых запрос имеет смысл повторить:
+# 6 — слишком много запросов в секунду, 9 — flood control, 10 — внутренняя ошибка сервера
+RETRY_CODES = {6, 9, 10}
+
+# random_id сообщения — положительное int32: VK не доставляет повторно сообщение с тем же random_id
+RANDOM_ID_MAX = 2 ** 31 - 1
+
+
+class TokenBucket:
+    """Ограничение частоты: rate запросов в секунду, до burst подряд"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться свободного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class OutboundQueue:
+    """Очередь исходящих запросов к VK API с общим ограничением частоты"""
+
+    def __init__(self, api, rate: float = 20, burst: int = 20, senders: int = 4,
+                 max_retries: int = 3, retry_delay: float = 0.5,
+                 users_batch: int = 100, users_window: float = 0.02):
+        """
+        :param rate: запросов в секунду (лимит VK для ключа сообщества — 20)
+        :param senders: сколько запросов может выполняться одновременно
+        :param max_retries: повторов после временной ошибки
+        :param retry_delay: пауза перед первым повтором, дальше удваивается
+        :param users_batch: максимум VK ID в одном users.get
+        :param users_window: сколько секунд собирать VK ID для users.get
+        """
+        self.api = api
+        self.bucket = TokenBucket(rate, burst)
+        self.senders = senders
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.users_batch = users_batch
+        self.users_window = users_window
+        self._queue = None
+        self._tasks = []
+        self._pending_users = {}  # VK ID -> ожидающие future
+        self._users_task = None
+
+    def limit_rate(self, rate: float, burst: int):
+        """Изменить ограничение частоты (например, доля общего лимита токена для процесса cluster.py)"""
+        self.bucket = TokenBucket(rate, max(1, burst))
+
+    def _ensure_started(self):
+        # Очередь и фоновые задачи создаются в работающем event loop бота
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [background_task(self._sender()) for _ in range(self.senders)]
+
+    # ============= СООБЩЕНИЯ =============
+    async def send(self, peer_id: int, message: str = None, **params):
+        """Отправить сообщение через очередь и дождаться ответа VK"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        # Один random_id на сообщение, а не на попытку: если VK принял сообщение, но ответ не дошёл,
+        # повтор из _call не продублирует его у пользователя
+        params = {'peer_id': peer_id, 'random_id': random.randint(1, RANDOM_ID_MAX), **params}
+        if message is not None:
+            params['message'] = message
+        self._queue.put_nowait((params, future, time.perf_counter()))
+        OUTBOUND_QUEUE_DEPTH.set(self._queue.qsize())
+        return await future
+
+    async def reply(self, message, text: str = None, **params):
+        """Ответ на входящее сообщение (замена message.answer)"""
+        return await self.send(message.peer_id, text, **params)
+
+    async def _sender(self):
+        while True:
+            params, future, queued = await self._queue.get()
+            OUTBOUND_QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                result = await self._call(self.api.messages.send, 'messages.send', **params)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                OUTBOUND_SEND_SECONDS.observe(time.perf_counter() - queued, method='messages.send')
+                self._queue.task_done()
+
+    # ============= ПОЛЬЗОВАТЕЛИ =============
+    async def get_user(self, vk_id: int):
+        """Профиль пользователя VK; запросы нескольких обработчиков объединяются в один users.get"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending_users.setdefault(vk_id, []).append(future)
+        if self._users_task is None:
+            self._users_task = background_task(self._fetch_users())
+        return await future
+
+    async def _fetch_users(self):
+        await asyncio.sleep(self.users_window)
+        pending, self._pending_users = self._pending_users, {}
+        self._users_task = None
+
+        vk_ids = list(pending)
+        for start in range(0, len(vk_ids), self.users_batch):
+            chunk = vk_ids[start:start + self.users_batch]
+            USERS_GET_BATCH.observe(len(chunk))
+            started = time.perf_counter()
+            try:
+                users = await self._call(self.api.users.get, 'users.get', user_ids=chunk)
+            except Exception as e:
+                for vk_id in chunk:
+                    for future in pending[vk_id]:
+                        if not future.done():
+                            future.set_exception(e)
+                continue
+            finally:
+                OUTBOUND_SEND_SECONDS.observe(time.perf_counter() - started, method='users.get')
+
+            found = {user.id: user for user in users}
+            for vk_id in chunk:
+                for future in pending[vk_id]:
+                    if not future.done():
+                        future.set_result(found.get(vk_id))
+
+    # ============= ПОВТОРЫ =============
+    async def _call(self, method, name: str, **params):
+        """Вызвать метод API с ограничением частоты и повторами временных ошибок"""
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                return await method(**params)
+            except VKAPIError as e:
+                if e.code not in RETRY_CODES or attempt == self.max_retries:
+                    OUTBOUND_FAILURES.inc(method=name)
+                    raise
+                error = e
+            except (ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    OUTBOUND_FAILURES.inc(method=name)
+                    raise
+                error = e
+            OUTBOUND_RETRIES.inc(method=name)
+            logger.warning(f"{name}: {error}, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def close(self, timeout: float = 10):
+        """Дождаться отправки очереди и остановить отправителей"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено сообщений при остановке: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
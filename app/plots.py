@@ -9,23 +9,24 @@ import numpy as np
 from datetime import datetime
 from typing import List, Dict
 import logging
-import os
+import time
+
+from renderer import select_label_indices
+from debug_capture import default_capture
 
 logger = logging.getLogger(__name__)
 
-# Дополнительная проверка
-logger.info(f"Matplotlib backend: {matplotlib.get_backend()}")
+# Выше этого числа точек подписываются только мин/макс/последний замер периода
+LABEL_LIMIT = 60
+
+logger.debug("matplotlib backend=%s", matplotlib.get_backend())
 
 
 def generate_glucose_plot(readings: List, history: List[Dict]) -> io.BytesIO:
     """
     Генерация графика уровня глюкозы с историей
     """
-    logger.info("=" * 50)
-    logger.info("НАЧАЛО ГЕНЕРАЦИИ ГРАФИКА")
-    logger.info(f"Matplotlib backend: {matplotlib.get_backend()}")
-    logger.info(f"Получено readings: {len(readings)}")
-
+    started = time.perf_counter()
     try:
         # Подготовка данных
         periods = []
@@ -55,10 +56,7 @@ def generate_glucose_plot(readings: List, history: List[Dict]) -> io.BytesIO:
                 else:
                     colors.append('blue')
 
-        logger.info(f"Подготовлено точек: {len(periods)}")
-
         if len(periods) < 2:
-            logger.error("Недостаточно данных для графика")
             raise ValueError("Нужно минимум 2 замера")
 
         # Создаем фигуру
@@ -73,12 +71,15 @@ def generate_glucose_plot(readings: List, history: List[Dict]) -> io.BytesIO:
         # Основной график
         x_pos = range(len(periods))
 
-        # Рисуем точки
-        for i, (x, y, color) in enumerate(zip(x_pos, values, colors)):
-            ax1.scatter(x, y, color=color, s=200, edgecolor='black',
-                        linewidth=2, zorder=5)
-            # Добавляем значение над точкой
-            ax1.annotate(f'{y:.1f}', (x, y), xytext=(0, 10),
+        # Рисуем все точки одним scatter
+        values_array = np.asarray(values)
+        ax1.scatter(x_pos, values_array, c=colors, s=200, edgecolor='black',
+                    linewidth=2, zorder=5)
+
+        # Добавляем значения над точками (на больших историях — только мин/макс/последний по периоду)
+        period_codes = np.fromiter((period_order[p] for p in periods), dtype=np.int8, count=len(periods))
+        for i in select_label_indices(values_array, period_codes, np.arange(len(values_array)), LABEL_LIMIT):
+            ax1.annotate(f'{values_array[i]:.1f}', (i, values_array[i]), xytext=(0, 10),
                          textcoords='offset points', ha='center',
                          fontsize=9, fontweight='bold')
 
@@ -149,22 +150,17 @@ def generate_glucose_plot(readings: List, history: List[Dict]) -> io.BytesIO:
 
         # Проверяем размер
         buffer_size = buffer.getbuffer().nbytes
-        logger.info(f"График создан, размер: {buffer_size} байт")
-
         if buffer_size < 100:
-            logger.error("Буфер слишком маленький!")
             raise ValueError("Созданный график имеет слишком малый размер")
 
-        # Для отладки сохраняем на диск
-        debug_path = os.path.join(os.path.dirname(__file__), 'debug_plot.png')
-        with open(debug_path, 'wb') as f:
-            f.write(buffer.getvalue())
-        logger.info(f"Отладочная копия сохранена: {debug_path}")
+        logger.debug("plot_rendered readings=%d points=%d bytes=%d seconds=%.3f",
+                     len(readings), len(periods), buffer_size, time.perf_counter() - started)
+
+        # Отладочная копия — только если включена, запись в фоновом потоке
+        default_capture().capture('plot', buffer.getvalue())
 
         return buffer
 
-    except Exception as e:
-        logger.error(f"Ошибка в generate_glucose_plot: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
+    except Exception:
+        logger.exception("plot_failed readings=%d", len(readings))
         raise
\ No newline at end of file
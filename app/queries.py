@@ -0,0 +1,482 @@
+"""
+Построители SQL-запросов, общие для бота и служебных скриптов
+"""
+import math
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, delete, case, func, Date, Integer, literal
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from database import (
+    User, GlucoseReading, UserPeriodStats, UserValueHistogram, DailyActivity, CacheVersion, IS_POSTGRESQL
+)
+
+
+# Границы времени в диапазоне (включительно), как на графиках: 4.0–7.0 и целевой 5.1–7.0
+TIME_IN_RANGE = (4.0, 7.0)
+TIME_IN_TARGET = (5.1, 7.0)
+
+
+def _within(value: float, bounds: tuple) -> bool:
+    return bounds[0] <= value <= bounds[1]
+
+
+def value_tenths(value: float) -> int:
+    """Значение в десятых долях, с тем же округлением, что tenths_bucket в SQL (половина — вверх)"""
+    return math.floor(value * 10 + 0.5)
+
+
+class day_bucket(FunctionElement):
+    """Начало дня для timestamp"""
+    type = Date()
+    inherit_cache = True
+    name = 'day_bucket'
+
+
+class week_bucket(FunctionElement):
+    """Начало недели (понедельник) для timestamp"""
+    type = Date()
+    inherit_cache = True
+    name = 'week_bucket'
+
+
+class tenths_bucket(FunctionElement):
+    """Значение в десятых долях для гистограммы: floor(value * 10 + 0.5), как value_tenths"""
+    type = Integer()
+    inherit_cache = True
+    name = 'tenths_bucket'
+
+
+DATE_BUCKETS = {'day': day_bucket, 'week': week_bucket}
+
+
+# date_trunc возвращает timestamp, а ключ группировки — дата, как в SQLite
+@compiles(day_bucket)
+def _compile_day_bucket(element, compiler, **kw):
+    return f"CAST(date_trunc('day', {compiler.process(element.clauses, **kw)}) AS DATE)"
+
+
+@compiles(day_bucket, 'sqlite')
+def _compile_day_bucket_sqlite(element, compiler, **kw):
+    return f"date({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(week_bucket)
+def _compile_week_bucket(element, compiler, **kw):
+    return f"CAST(date_trunc('week', {compiler.process(element.clauses, **kw)}) AS DATE)"
+
+
+# round() в PostgreSQL округляет половины к чётному, поэтому округление записано через floor
+@compiles(tenths_bucket)
+def _compile_tenths_bucket(element, compiler, **kw):
+    return f"CAST(floor({compiler.process(element.clauses, **kw)} * 10 + 0.5) AS INTEGER)"
+
+
+# floor в SQLite есть не во всех сборках; значения глюкозы положительны, а CAST отбрасывает дробную часть
+@compiles(tenths_bucket, 'sqlite')
+def _compile_tenths_bucket_sqlite(element, compiler, **kw):
+    return f"CAST({compiler.process(element.clauses, **kw)} * 10 + 0.5 AS INTEGER)"
+
+
+@compiles(week_bucket, 'sqlite')
+def _compile_week_bucket_sqlite(element, compiler, **kw):
+    # Ближайшее воскресенье минус 6 дней — понедельник той же недели
+    return f"date({compiler.process(element.clauses, **kw)}, 'weekday 0', '-6 days')"
+
+
+def upsert(table):
+    """
+    INSERT ... ON CONFLICT для накопительных таблиц: одна атомарная команда вместо UPDATE и INSERT,
+    поэтому параллельные транзакции (в PostgreSQL нет общей блокировки записи, как в SQLite)
+    не вставляют одну строку дважды. Конструкция INSERT берётся из диалекта базы DATABASE_URL
+    (ON CONFLICT есть в SQLite 3.24+ и PostgreSQL)
+    """
+    dialect_insert = postgresql_insert if IS_POSTGRESQL else sqlite_insert
+    return dialect_insert(getattr(table, '__table__', table))
+
+
+def period_stats_upsert():
+    """
+    Добавить агрегат новых замеров к статистике (или создать строку периода)
+    Параметры выполнения — period_stats_params, можно списком (executemany)
+    """
+    s = UserPeriodStats.__table__.c
+    statement = upsert(UserPeriodStats)
+    new = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[s.user_id, s.period],
+        set_={
+            'count': s.count + new.count,
+            'value_sum': s.value_sum + new.value_sum,
+            'value_sum_sq': s.value_sum_sq + new.value_sum_sq,
+            'min_value': case((s.min_value > new.min_value, new.min_value), else_=s.min_value),
+            'max_value': case((s.max_value < new.max_value, new.max_value), else_=s.max_value),
+            'first_timestamp': case((s.first_timestamp > new.first_timestamp, new.first_timestamp),
+                                    else_=s.first_timestamp),
+            'last_timestamp': case((s.last_timestamp < new.last_timestamp, new.last_timestamp),
+                                   else_=s.last_timestamp),
+            'in_range': s.in_range + new.in_range,
+            'in_target': s.in_target + new.in_target,
+        }
+    )
+
+
+def period_stats_params(deltas: dict) -> list:
+    """Параметры period_stats_upsert из агрегатов {(user_id, period): агрегат}"""
+    return [{'user_id': user_id, 'period': period, **delta} for (user_id, period), delta in deltas.items()]
+
+
+def reading_stats_delta(value: float, timestamp) -> dict:
+    """Агрегат одного замера в формате period_stats_params"""
+    return {
+        'count': 1,
+        'value_sum': value,
+        'value_sum_sq': value * value,
+        'min_value': value,
+        'max_value': value,
+        'first_timestamp': timestamp,
+        'last_timestamp': timestamp,
+        'in_range': int(_within(value, TIME_IN_RANGE)),
+        'in_target': int(_within(value, TIME_IN_TARGET))
+    }
+
+
+def readings_stats_deltas(readings) -> dict:
+    """Агрегаты новых замеров по (user_id, period) в формате period_stats_params"""
+    deltas = {}
+    for reading in readings:
+        key = (reading.user_id, reading.period)
+        delta = deltas.get(key)
+        if delta is None:
+            deltas[key] = reading_stats_delta(reading.value, reading.timestamp)
+            continue
+        delta['count'] += 1
+        delta['value_sum'] += reading.value
+        delta['value_sum_sq'] += reading.value * reading.value
+        delta['min_value'] = min(delta['min_value'], reading.value)
+        delta['max_value'] = max(delta['max_value'], reading.value)
+        delta['first_timestamp'] = min(delta['first_timestamp'], reading.timestamp)
+        delta['last_timestamp'] = max(delta['last_timestamp'], reading.timestamp)
+        delta['in_range'] += _within(reading.value, TIME_IN_RANGE)
+        delta['in_target'] += _within(reading.value, TIME_IN_TARGET)
+    return deltas
+
+
+def histogram_upsert():
+    """Добавить замеры к строке гистограммы (user_id, period, tenths); параметры — histogram_params"""
+    h = UserValueHistogram.__table__.c
+    statement = upsert(UserValueHistogram)
+    return statement.on_conflict_do_update(
+        index_elements=[h.user_id, h.period, h.tenths],
+        set_={'count': h.count + statement.excluded.count}
+    )
+
+
+def histogram_params(deltas) -> list:
+    """Параметры histogram_upsert из {(user_id, period, tenths): count}"""
+    return [{'user_id': user_id, 'period': period, 'tenths': tenths, 'count': count}
+            for (user_id, period, tenths), count in deltas.items()]
+
+
+def readings_histogram_deltas(readings) -> Counter:
+    """Число новых замеров по (user_id, period, tenths)"""
+    return Counter((reading.user_id, reading.period, value_tenths(reading.value)) for reading in readings)
+
+
+def user_histogram_query(user_id: int):
+    """Гистограмма пользователя из накопительной таблицы: (period, tenths, count)"""
+    h = UserValueHistogram
+    return select(h.period, h.tenths, h.count).where(h.user_id == user_id)
+
+
+def user_period_stats_query(user_id: int):
+    """Строки накопительной статистики пользователя в порядке первого замера"""
+    return (
+        select(UserPeriodStats)
+        .filter_by(user_id=user_id)
+        .order_by(UserPeriodStats.first_timestamp)
+    )
+
+
+def rebuild_period_stats_statements(user_id: int = None):
+    """DELETE + INSERT ... SELECT для пересчёта статистики и гистограммы из glucose_readings"""
+    r = GlucoseReading
+    aggregate = (
+        select(
+            r.user_id,
+            r.period,
+            func.count(r.id),
+            func.sum(r.value),
+            func.sum(r.value * r.value),
+            func.min(r.value),
+            func.max(r.value),
+            func.min(r.timestamp),
+            func.max(r.timestamp),
+            func.sum(case((r.value.between(*TIME_IN_RANGE), 1), else_=0)),
+            func.sum(case((r.value.between(*TIME_IN_TARGET), 1), else_=0))
+        )
+        .group_by(r.user_id, r.period)
+    )
+    histogram = readings_histogram_query(user_id)
+    clear = delete(UserPeriodStats)
+    clear_histogram = delete(UserValueHistogram)
+
+    if user_id is not None:
+        aggregate = aggregate.where(r.user_id == user_id)
+        clear = clear.where(UserPeriodStats.user_id == user_id)
+        clear_histogram = clear_histogram.where(UserValueHistogram.user_id == user_id)
+
+    fill = insert(UserPeriodStats).from_select(
+        ['user_id', 'period', 'count', 'value_sum', 'value_sum_sq',
+         'min_value', 'max_value', 'first_timestamp', 'last_timestamp', 'in_range', 'in_target'],
+        aggregate
+    )
+    fill_histogram = insert(UserValueHistogram).from_select(['user_id', 'period', 'tenths', 'count'], histogram)
+    return clear, fill, clear_histogram, fill_histogram
+
+
+def daily_activity_upsert():
+    """Добавить к дню замеры, активных и новых пользователей; параметры — daily_activity_params"""
+    a = DailyActivity.__table__.c
+    statement = upsert(DailyActivity)
+    new = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[a.date],
+        set_={
+            'readings': a.readings + new.readings,
+            'active_users': a.active_users + new.active_users,
+            'new_users': a.new_users + new.new_users,
+        }
+    )
+
+
+def daily_activity_params(deltas: dict) -> list:
+    """Параметры daily_activity_upsert из {date: {'readings': n, 'active_users': m, 'new_users': k}}"""
+    return [{'date': date, 'readings': 0, 'active_users': 0, 'new_users': 0, **delta}
+            for date, delta in deltas.items()]
+
+
+def cache_version_query(name: str):
+    """Текущая версия данных кэша (None, если ещё не менялась)"""
+    return select(CacheVersion.version).where(CacheVersion.name == name)
+
+
+def cache_version_bump(name: str):
+    """Увеличить версию данных кэша (первая версия — 1)"""
+    c = CacheVersion.__table__.c
+    statement = upsert(CacheVersion).values(name=name, version=1)
+    return statement.on_conflict_do_update(index_elements=[c.name], set_={'version': c.version + 1})
+
+
+def user_insert_missing(vk_id: int, name: str, is_admin: bool = False):
+    """Создать пользователя, если его ещё нет; возвращает vk_id только созданной строки"""
+    users = User.__table__.c
+    return (
+        upsert(User)
+        .values(vk_id=vk_id, name=name, is_admin=is_admin, registered_at=datetime.now())
+        .on_conflict_do_nothing(index_elements=[users.vk_id])
+        .returning(users.vk_id)
+    )
+
+
+def users_last_reading_query(user_ids):
+    """Время последнего замера пользователей по накопительной статистике: (user_id, last_timestamp)"""
+    s = UserPeriodStats
+    return (
+        select(s.user_id, func.max(s.last_timestamp))
+        .where(s.user_id.in_(user_ids))
+        .group_by(s.user_id)
+    )
+
+
+def readings_activity_deltas(readings, last_readings: dict = None, known_days=None) -> dict:
+    """
+    Прирост дневной активности от новых замеров {date: {'readings': n, 'active_users': m}}
+    Пользователь становится активным в день, если раньше в этот день замеров не было
+    :param last_readings: время последнего замера до вставки {user_id: timestamp}
+        (новые замеры позже всех сохранённых — ввод через бота)
+    :param known_days: пары (user_id, date), в которые замеры уже были (загрузка истории за любые дни)
+    """
+    deltas = {}
+    days = set()
+    for reading in readings:
+        day = reading.timestamp.date()
+        delta = deltas.setdefault(day, {'readings': 0, 'active_users': 0})
+        delta['readings'] += 1
+        days.add((reading.user_id, day))
+
+    for user_id, day in days:
+        if known_days is not None:
+            active = (user_id, day) not in known_days
+        else:
+            last = last_readings.get(user_id)
+            active = last is None or last.date() < day
+        if active:
+            deltas[day]['active_users'] += 1
+    return deltas
+
+
+def activity_totals_query():
+    """Всего замеров и пользователей по дневной активности: (readings, users)"""
+    a = DailyActivity
+    return select(
+        func.coalesce(func.sum(a.readings), 0),
+        func.coalesce(func.sum(a.new_users), 0)
+    )
+
+
+def daily_activity_query(days: int):
+    """Дневная активность за последние days дней по возрастанию даты"""
+    since = (datetime.now() - timedelta(days=days - 1)).date()
+    return select(DailyActivity).where(DailyActivity.date >= since).order_by(DailyActivity.date)
+
+
+def rebuild_daily_activity_statements():
+    """DELETE + INSERT ... SELECT для пересчёта daily_activity по замерам и датам регистрации"""
+    r = GlucoseReading
+    a = DailyActivity
+    reading_day = day_bucket(r.timestamp)
+    registered_day = day_bucket(User.registered_at)
+
+    clear = delete(a)
+    fill = insert(a).from_select(
+        ['date', 'readings', 'active_users', 'new_users'],
+        select(reading_day, func.count(r.id), func.count(r.user_id.distinct()), literal(0))
+        .group_by(reading_day)
+    )
+    # Новые пользователи: в дни с замерами — UPDATE, в остальные дни — отдельные строки
+    fill_new_users = (
+        update(a)
+        .values(new_users=(
+            select(func.count(User.id))
+            .where(registered_day == a.date)
+            .scalar_subquery()
+        ))
+    )
+    fill_registrations = insert(a).from_select(
+        ['date', 'readings', 'active_users', 'new_users'],
+        select(registered_day, literal(0), literal(0), func.count(User.id))
+        .where(User.registered_at.is_not(None), registered_day.not_in(select(a.date)))
+        .group_by(registered_day)
+    )
+    return clear, fill, fill_new_users, fill_registrations
+
+
+def readings_histogram_query(user_id: int = None):
+    """Гистограмма по замерам: (user_id, period, значение в десятых долях, count)"""
+    r = GlucoseReading
+    tenths = tenths_bucket(r.value).label('tenths')
+    query = (
+        select(r.user_id, r.period, tenths, func.count().label('count'))
+        .group_by(r.user_id, r.period, tenths)
+    )
+    if user_id is not None:
+        query = query.where(r.user_id == user_id)
+    return query
+
+
+def window_start(days: int) -> datetime:
+    """
+    Начало окна графика «за N дней», с точностью до часа: по нему же строится ключ кэша графика,
+    поэтому кэшированный график отстаёт от текущего окна не больше чем на час
+    """
+    return (datetime.now() - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+
+
+def readings_window_query(user_id: int, days: int = None):
+    """Замеры пользователя за окно: только (timestamp, value, period) по индексу user_id + timestamp"""
+    r = GlucoseReading
+    query = select(r.timestamp, r.value, r.period).where(r.user_id == user_id)
+
+    if days is not None:
+        query = query.where(r.timestamp >= window_start(days))
+
+    return query.order_by(r.timestamp)
+
+
+def readings_buckets_query(user_id: int, unit: str = 'day'):
+    """Замеры пользователя, сгруппированные по дню/неделе и периоду: (bucket, period, min, avg, max, count)"""
+    r = GlucoseReading
+    bucket = DATE_BUCKETS[unit](r.timestamp).label('bucket')
+    return (
+        select(
+            bucket,
+            r.period,
+            func.min(r.value).label('min_value'),
+            func.avg(r.value).label('avg_value'),
+            func.max(r.value).label('max_value'),
+            func.count(r.id).label('count')
+        )
+        .where(r.user_id == user_id)
+        .group_by(bucket, r.period)
+        .order_by(bucket)
+    )
+
+
+def export_readings_query(user_id: int = None, exclude_ids=()):
+    """
+    Замеры для выгрузки с именем клиента в порядке (user_id, timestamp) — по индексу замеров
+    :param exclude_ids: пользователи, замеры которых не выгружаются (администраторы)
+    """
+    r = GlucoseReading
+    query = (
+        select(r.user_id, User.name, r.timestamp, r.value, r.period)
+        .join(User, User.vk_id == r.user_id)
+        .order_by(r.user_id, r.timestamp)
+    )
+    if user_id is not None:
+        query = query.where(r.user_id == user_id)
+    if exclude_ids:
+        query = query.where(r.user_id.notin_(exclude_ids))
+    return query
+
+
+def existing_readings_query(user_ids, since, until):
+    """Уже сохранённые замеры пользователей за интервал [since, until) (для исключения дублей при загрузке)"""
+    r = GlucoseReading
+    return (
+        select(r.user_id, r.timestamp, r.value, r.period)
+        .where(r.user_id.in_(user_ids), r.timestamp >= since, r.timestamp < until)
+    )
+
+
+def reading_days_query(user_id: int, until):
+    """Дни, в которые у пользователя есть замеры в базе раньше until (чтобы не учесть его активным дважды)"""
+    r = GlucoseReading
+    return select(day_bucket(r.timestamp).distinct()).where(r.user_id == user_id, r.timestamp < until)
+
+
+def clients_overview_query(include_admins: bool = False):
+    """
+    Пользователи с количеством замеров и средним значением одним запросом:
+    GROUP BY user_id по накопительной статистике, соединённый с users
+    """
+    totals = (
+        select(
+            UserPeriodStats.user_id,
+            func.sum(UserPeriodStats.count).label('readings'),
+            func.sum(UserPeriodStats.value_sum).label('value_sum'),
+            func.sum(UserPeriodStats.in_range).label('in_range')
+        )
+        .group_by(UserPeriodStats.user_id)
+        .subquery()
+    )
+    query = (
+        select(
+            User.id,
+            User.vk_id,
+            User.name,
+            User.is_admin,
+            func.coalesce(totals.c.readings, 0).label('readings'),
+            (totals.c.value_sum / totals.c.readings).label('avg'),
+            (totals.c.in_range * 100.0 / totals.c.readings).label('tir')
+        )
+        .outerjoin(totals, totals.c.user_id == User.vk_id)
+    )
+    if not include_admins:
+        query = query.where(User.is_admin.is_(False))
+    return query
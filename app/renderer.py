@@ -0,0 +1,211 @@
+"""
+Сервис отрисовки графиков глюкозы в пуле процессов
+Event loop бота только передаёт массивы и получает готовый PNG
+numpy и matplotlib импортируются при первом графике, а не при запуске бота
+"""
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Порядок периодов на оси X; в воркер передаются индексы из этого списка
+ALL_PERIODS = [
+    'Перед завтраком', 'Перед обедом', 'Перед ужином',
+    'Перед сном', 'Ночью', 'Через час после еды'
+]
+PERIOD_CODES = {period: code for code, period in enumerate(ALL_PERIODS)}
+
+RENDER_QUEUE_DEPTH = Gauge('render_queue_depth', 'Графики в очереди и в отрисовке')
+RENDER_SECONDS = Histogram('render_seconds', 'Время отрисовки графика в воркере')
+RENDER_TOTAL_SECONDS = Histogram('render_total_seconds', 'Время от постановки в очередь до получения PNG')
+RENDER_REJECTED = Counter('render_rejected_total', 'Запросы графиков, отклонённые из-за переполнения очереди')
+
+
+class RenderQueueFull(Exception):
+    """Очередь отрисовки переполнена"""
+
+
+def readings_to_arrays(readings):
+    """Преобразовать замеры в массивы (timestamps, values, period_codes)"""
+    import numpy as np
+
+    rows = [(r.timestamp.timestamp(), r.value, PERIOD_CODES[r.period])
+            for r in readings if r.period in PERIOD_CODES]
+    timestamps = np.fromiter((row[0] for row in rows), dtype=np.float64, count=len(rows))
+    values = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    periods = np.fromiter((row[2] for row in rows), dtype=np.int8, count=len(rows))
+    return timestamps, values, periods
+
+
+def buckets_to_arrays(rows):
+    """
+    Преобразовать агрегаты (bucket, period, min, avg, max, count) в массивы
+    :return: (timestamps, средние, period_codes, (минимумы, максимумы, количества))
+    """
+    import numpy as np
+
+    rows = [row for row in rows if row.period in PERIOD_CODES]
+    size = len(rows)
+    timestamps = np.fromiter((time.mktime(row.bucket.timetuple()) for row in rows), dtype=np.float64, count=size)
+    means = np.fromiter((row.avg_value for row in rows), dtype=np.float64, count=size)
+    periods = np.fromiter((PERIOD_CODES[row.period] for row in rows), dtype=np.int8, count=size)
+    mins = np.fromiter((row.min_value for row in rows), dtype=np.float64, count=size)
+    maxs = np.fromiter((row.max_value for row in rows), dtype=np.float64, count=size)
+    counts = np.fromiter((row.count for row in rows), dtype=np.int64, count=size)
+    return timestamps, means, periods, (mins, maxs, counts)
+
+
+def _init_worker():
+    """Прогрев воркера: бэкенд Agg и импорт pyplot один раз на процесс"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401
+
+
+def select_label_indices(values, groups, timestamps, limit: int):
+    """
+    Индексы точек, над которыми подписывается значение
+    До limit точек подписываются все, выше — только мин/макс/последний замер каждой группы
+    """
+    import numpy as np
+
+    if len(values) <= limit:
+        return np.arange(len(values))
+
+    picked = []
+    for group in np.unique(groups):
+        idx = np.flatnonzero(groups == group)
+        picked.extend((
+            idx[np.argmin(values[idx])],
+            idx[np.argmax(values[idx])],
+            idx[np.argmax(timestamps[idx])]
+        ))
+    return np.unique(picked)
+
+
+def render_chart(timestamps, values, periods, user_name: str, period_text: str,
+                 label_limit: int = 60, spread=None):
+    """
+    Отрисовать график в PNG (выполняется в процессе пула)
+    Все точки рисуются одним scatter, подписи прореживаются выше label_limit
+    :param spread: для агрегированных данных — (минимумы, максимумы, количества);
+                   values тогда содержит средние по корзинам
+    :return: (PNG в байтах, время отрисовки в секундах)
+    """
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    started = time.perf_counter()
+    fig, ax = plt.subplots(figsize=(14, 8))
+
+    if len(values):
+        x = periods + np.random.normal(0, 0.05, len(values))
+        colors = np.where(periods == PERIOD_CODES['Через час после еды'], 'orange', 'blue')
+
+        if spread is not None:
+            # Разброс внутри корзины одной коллекцией линий
+            ax.vlines(x, spread[0], spread[1], colors=colors, linewidth=1, alpha=0.4, zorder=4)
+
+        ax.scatter(x, values, c=colors, s=150,
+                   zorder=5, edgecolors='black', linewidth=2, alpha=0.8)
+
+        for i in select_label_indices(values, periods, timestamps, label_limit):
+            ax.annotate(f'{values[i]:.1f}', (x[i], values[i]), xytext=(0, 15),
+                        textcoords='offset points', ha='center', fontsize=9,
+                        bbox=dict(boxstyle='round,pad=0.2', facecolor='white', alpha=0.9))
+
+    ax.axhline(y=5.1, color='green', linewidth=2, linestyle='-', alpha=0.7, label='Цель 5.1')
+    ax.axhline(y=7.0, color='red', linewidth=2, linestyle='-', alpha=0.7, label='Граница 7.0')
+    ax.axhspan(5.1, 7.0, alpha=0.15, color='green')
+
+    ax.set_xticks(range(len(ALL_PERIODS)))
+    ax.set_xticklabels(ALL_PERIODS, rotation=45, ha='right', fontsize=11)
+    ax.set_ylabel('Глюкоза (ммоль/л)', fontsize=12)
+    ax.set_title(f'График глюкозы: {user_name} ({period_text})',
+                 fontsize=16, fontweight='bold')
+    ax.grid(True, alpha=0.3, linestyle='--', axis='y')
+    ax.legend(loc='upper right')
+
+    if len(values):
+        if spread is not None:
+            mins, maxs, counts = spread
+            stats_text = f"Всего замеров: {counts.sum()}\n"
+            stats_text += f"Среднее: {np.average(values, weights=counts):.1f}\n"
+            stats_text += f"Мин: {mins.min():.1f}\n"
+            stats_text += f"Макс: {maxs.max():.1f}"
+        else:
+            stats_text = f"Всего замеров: {len(values)}\n"
+            stats_text += f"Среднее: {np.mean(values):.1f}\n"
+            stats_text += f"Мин: {np.min(values):.1f}\n"
+            stats_text += f"Макс: {np.max(values):.1f}"
+
+        ax.text(1.02, 0.98, stats_text, transform=ax.transAxes,
+                fontsize=9, verticalalignment='top',
+                bbox=dict(boxstyle='round', facecolor='white', alpha=0.9))
+
+    plt.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=120, bbox_inches='tight')
+    plt.close(fig)
+
+    return buffer.getvalue(), time.perf_counter() - started
+
+
+class ChartRenderer:
+    """Ограниченный пул процессов для отрисовки графиков"""
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 16, label_limit: int = 60,
+                 debug_capture=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.label_limit = label_limit
+        self.debug_capture = debug_capture
+        self._executor = None
+        self._pending = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Пул создаётся при первом графике, чтобы не замедлять запуск бота
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker)
+            logger.info(f"Запущен пул отрисовки графиков: {self.max_workers} процесс(ов)")
+        return self._executor
+
+    async def render(self, timestamps, values, periods, user_name: str, period_text: str,
+                     spread=None) -> bytes:
+        """Отрисовать график в пуле процессов и вернуть PNG"""
+        if self._pending >= self.max_queue:
+            RENDER_REJECTED.inc()
+            raise RenderQueueFull(f"В очереди уже {self._pending} графиков")
+
+        self._pending += 1
+        RENDER_QUEUE_DEPTH.set(self._pending)
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            png, render_time = await loop.run_in_executor(
+                self._get_executor(), render_chart,
+                timestamps, values, periods, user_name, period_text, self.label_limit, spread
+            )
+            RENDER_SECONDS.observe(render_time)
+            if self.debug_capture is not None:
+                self.debug_capture.capture('chart', png)
+            return png
+        finally:
+            self._pending -= 1
+            RENDER_QUEUE_DEPTH.set(self._pending)
+            RENDER_TOTAL_SECONDS.observe(time.perf_counter() - started)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,395 @@
+"""
+Асинхронный доступ к данным для бота
+Все функции выполняются через пул соединений AsyncSession и не блокируют event loop
+"""
+from sqlalchemy import select, func
+from datetime import datetime
+from operator import attrgetter
+import asyncio
+import logging
+import math
+import time
+
+from database import AsyncSession, User, GlucoseReading, UserPeriodStats, DailyActivity
+from queries import (
+    period_stats_upsert, period_stats_params, readings_stats_deltas, user_period_stats_query,
+    readings_window_query, window_start, readings_buckets_query, clients_overview_query,
+    histogram_upsert, histogram_params, readings_histogram_deltas, user_histogram_query,
+    daily_activity_upsert, daily_activity_params, users_last_reading_query, readings_activity_deltas,
+    activity_totals_query, daily_activity_query, cache_version_query, user_insert_missing
+)
+from renderer import buckets_to_arrays
+from archive import has_archive, archived_readings, archived_buckets, merge_buckets
+from config import ADMIN_IDS, USER_CACHE_CHECK_INTERVAL
+from cache import user_cache, UserProfile, MISSING, invalidate_user_charts, USER_CACHE_VERSION
+
+logger = logging.getLogger(__name__)
+
+# Сколько агрегированных строк читать из курсора за раз
+BUCKET_FETCH_SIZE = 1000
+
+# Процентили в статистике пользователя
+PERCENTILES = {'p25': 0.25, 'median': 0.5, 'p75': 0.75}
+
+# Последняя прочитанная версия профилей (cache_versions) и время проверки
+_user_cache_version = None
+_user_cache_checked = float('-inf')
+
+
+# ============= ПОЛЬЗОВАТЕЛИ =============
+async def get_or_create_user(vk_id: int, name: str = None):
+    """Получить или создать пользователя в базе"""
+    profile = await get_user(vk_id)
+    if profile is not None:
+        return profile
+
+    async with AsyncSession() as session:
+        try:
+            user = await session.scalar(select(User).filter_by(vk_id=vk_id))
+
+            if not user:
+                # Проверяем, является ли пользователь администратором
+                is_admin = vk_id in ADMIN_IDS
+                name = name or f"User_{vk_id}"
+                # Строку могла уже создать параллельная транзакция (например, первый замер) — вставка пропускается
+                if await _insert_user(session, vk_id, name, is_admin):
+                    await session.execute(daily_activity_upsert(),
+                                          daily_activity_params({datetime.now().date(): {'new_users': 1}}))
+                    logger.info(f"Создан новый пользователь: {name} (admin={is_admin})")
+                await session.commit()
+                user = await session.scalar(select(User).filter_by(vk_id=vk_id))
+
+            # В кэше остался «пользователь не найден» — заменяем на свежий профиль
+            user_cache.invalidate(vk_id)
+            profile = UserProfile(user.vk_id, user.name, bool(user.is_admin))
+            user_cache.set(vk_id, profile)
+            return profile
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Ошибка в get_or_create_user: {e}")
+            raise
+
+
+async def sync_user_cache():
+    """
+    Сбросить кэш профилей, если их изменил другой процесс (fix_users.py увеличивает версию в cache_versions)
+    База опрашивается не чаще раза в USER_CACHE_CHECK_INTERVAL секунд
+    """
+    global _user_cache_version, _user_cache_checked
+    now = time.monotonic()
+    if now - _user_cache_checked < USER_CACHE_CHECK_INTERVAL:
+        return
+    # Время проверки ставится до запроса: одновременные обработчики не опрашивают базу повторно
+    _user_cache_checked = now
+
+    async with AsyncSession() as session:
+        version = await session.scalar(cache_version_query(USER_CACHE_VERSION))
+    if version != _user_cache_version:
+        _user_cache_version = version
+        user_cache.clear()
+
+
+async def get_user(vk_id: int):
+    """Получить профиль пользователя по VK ID из кэша или базы (None, если не найден)"""
+    await sync_user_cache()
+    profile = user_cache.get(vk_id)
+    if profile is not MISSING:
+        return profile
+
+    async with AsyncSession() as session:
+        user = await session.scalar(select(User).filter_by(vk_id=vk_id))
+
+    profile = UserProfile(user.vk_id, user.name, bool(user.is_admin)) if user else None
+    user_cache.set(vk_id, profile)
+    return profile
+
+
+async def is_admin(vk_id: int) -> bool:
+    """Проверка, является ли пользователь администратором"""
+    profile = await get_user(vk_id)
+    return bool(profile and profile.is_admin)
+
+
+# ============= ЗАМЕРЫ =============
+async def get_user_readings(user_id: int, days: int = None):
+    """
+    Получить показания пользователя в виде строк (timestamp, value, period)
+    Старые замеры, перенесённые в архив (archive.py), добавляются к замерам из базы
+    :param user_id: ID пользователя
+    :param days: количество дней (None = все дни)
+    """
+    async with AsyncSession() as session:
+        result = await session.execute(readings_window_query(user_id, days))
+        readings = result.all()
+
+    if not has_archive(user_id):
+        return readings
+
+    since = window_start(days) if days is not None else None
+    archived = await asyncio.get_running_loop().run_in_executor(None, archived_readings, user_id, since)
+    # Обычно архив целиком старше базы, но загрузка истории может добавить в базу и более ранние замеры
+    return sorted(archived + readings, key=attrgetter('timestamp')) if archived else readings
+
+
+async def count_user_readings(user_id: int) -> int:
+    """Количество записей пользователя (по накопительной статистике)"""
+    async with AsyncSession() as session:
+        total = await session.scalar(
+            select(func.sum(UserPeriodStats.count)).filter_by(user_id=user_id)
+        )
+        return total or 0
+
+
+async def get_user_reading_buckets(user_id: int, unit: str = 'day'):
+    """
+    Агрегаты замеров по дню/неделе и периоду (min/mean/max), потоково через yield_per
+    Размер результата ограничен числом корзин, а не числом замеров
+    Агрегаты архива (archive.py) объединяются с агрегатами базы
+    :return: (timestamps, средние, period_codes, (минимумы, максимумы, количества))
+    """
+    parts = []
+    async with AsyncSession() as session:
+        result = await session.stream(
+            readings_buckets_query(user_id, unit).execution_options(yield_per=BUCKET_FETCH_SIZE)
+        )
+        async for partition in result.partitions():
+            parts.append(buckets_to_arrays(partition))
+
+    if not parts:
+        buckets = buckets_to_arrays([])
+    else:
+        import numpy as np
+
+        timestamps, means, periods, spreads = zip(*parts)
+        buckets = (
+            np.concatenate(timestamps),
+            np.concatenate(means),
+            np.concatenate(periods),
+            tuple(np.concatenate(column) for column in zip(*spreads))
+        )
+
+    if has_archive(user_id):
+        archived = await asyncio.get_running_loop().run_in_executor(None, archived_buckets, user_id, unit)
+        buckets = merge_buckets(buckets, archived)
+    return buckets
+
+
+async def get_readings_version(user_id: int):
+    """
+    Версия данных пользователя для кэша графиков:
+    (количество замеров, время первого, время последнего)
+    """
+    async with AsyncSession() as session:
+        result = await session.execute(
+            select(
+                func.sum(UserPeriodStats.count),
+                func.min(UserPeriodStats.first_timestamp),
+                func.max(UserPeriodStats.last_timestamp)
+            )
+            .filter_by(user_id=user_id)
+        )
+        return tuple(result.one())
+
+
+async def get_user_statistics(user_id: int):
+    """
+    Полная статистика пользователя за всё время
+    Среднее, SD и время в диапазоне — из накопительной таблицы, процентили — по накопительной
+    гистограмме значений; объём чтения не зависит от длины истории
+    """
+    async with AsyncSession() as session:
+        rows = (await session.scalars(user_period_stats_query(user_id))).all()
+        histogram = (await session.execute(user_histogram_query(user_id))).all() if rows else []
+
+    return summarize_statistics(rows, histogram)
+
+
+def _standard_deviation(count: int, value_sum: float, value_sum_sq: float) -> float:
+    """Выборочное стандартное отклонение по сумме и сумме квадратов"""
+    if count < 2:
+        return 0.0
+    variance = (value_sum_sq - value_sum * value_sum / count) / (count - 1)
+    return math.sqrt(max(variance, 0.0))
+
+
+def _histogram_percentiles(tenths, counts) -> dict:
+    """
+    Процентили по гистограмме значений (в десятых долях) одним проходом numpy
+    Линейная интерполяция между соседними замерами, как np.percentile по самим значениям:
+    медиана [5.6, 7.0] — 6.3
+    """
+    import numpy as np
+
+    if not len(tenths):
+        return dict.fromkeys(PERCENTILES)
+
+    order = np.argsort(tenths)
+    values = tenths[order]
+    cumulative = np.cumsum(counts[order])
+    quantiles = np.fromiter(PERCENTILES.values(), dtype=np.float64)
+    positions = quantiles * (cumulative[-1] - 1)
+    lower = np.floor(positions)
+    upper = np.minimum(lower + 1, cumulative[-1] - 1)
+    # Значение замера с номером k (с нуля) — первая ячейка, где накопленное число больше k
+    low_values = values[np.searchsorted(cumulative, lower, side='right')]
+    high_values = values[np.searchsorted(cumulative, upper, side='right')]
+    picked = (low_values + (positions - lower) * (high_values - low_values)) / 10
+    return dict(zip(PERCENTILES, picked.tolist()))
+
+
+def _summary(count, value_sum, value_sum_sq, min_value, max_value, in_range, in_target, percentiles) -> dict:
+    avg = value_sum / count
+    return {
+        'count': count,
+        'avg': avg,
+        'sd': _standard_deviation(count, value_sum, value_sum_sq),
+        'min': min_value,
+        'max': max_value,
+        'tir': in_range * 100 / count,
+        'tir_target': in_target * 100 / count,
+        # Без гистограммы (замеры ещё не попали в выборку) процентили заменяются средним
+        **{name: avg if value is None else value for name, value in percentiles.items()}
+    }
+
+
+def summarize_statistics(rows, histogram) -> dict:
+    """
+    Статистика из строк user_period_stats и гистограммы (period, tenths, count)
+    :return: общие показатели, 'by_period' по периодам и даты первого/последнего замера
+    """
+    if not rows:
+        return {
+            'total': 0,
+            'avg': 0,
+            'min': 0,
+            'max': 0,
+            'by_period': {},
+            'first_date': None,
+            'last_date': None
+        }
+
+    import numpy as np
+
+    periods = np.array([row.period for row in histogram], dtype=object)
+    tenths = np.fromiter((row.tenths for row in histogram), dtype=np.int64, count=len(histogram))
+    counts = np.fromiter((row.count for row in histogram), dtype=np.int64, count=len(histogram))
+
+    # Статистика по периодам
+    period_stats = {}
+    for row in rows:
+        mask = periods == row.period
+        period_stats[row.period] = _summary(
+            row.count, row.value_sum, row.value_sum_sq, row.min_value, row.max_value,
+            row.in_range, row.in_target, _histogram_percentiles(tenths[mask], counts[mask])
+        )
+
+    overall = _summary(
+        sum(row.count for row in rows),
+        sum(row.value_sum for row in rows),
+        sum(row.value_sum_sq for row in rows),
+        min(row.min_value for row in rows),
+        max(row.max_value for row in rows),
+        sum(row.in_range for row in rows),
+        sum(row.in_target for row in rows),
+        _histogram_percentiles(tenths, counts)
+    )
+    total = overall.pop('count')
+    return {
+        'total': total,
+        **overall,
+        'by_period': period_stats,
+        'first_date': min(row.first_timestamp for row in rows),
+        'last_date': max(row.last_timestamp for row in rows)
+    }
+
+
+async def store_readings(session, readings) -> dict:
+    """
+    Добавить замеры в сессию и обновить накопительную статистику и гистограмму (без commit)
+    :return: общее количество записей каждого пользователя после вставки {user_id: total}
+    """
+    user_ids = {reading.user_id for reading in readings}
+
+    # Активность за день — по последнему замеру до вставки, поэтому до обновления статистики
+    last_readings = dict((await session.execute(users_last_reading_query(user_ids))).all())
+    activity = readings_activity_deltas(readings, last_readings)
+
+    # Замер может прийти от пользователя без профиля (не писал /start): замеры ссылаются на users,
+    # поэтому профиль создаётся до вставки. Проверяются только пользователи без статистики
+    today = datetime.now().date()
+    for user_id in sorted(user_ids - set(last_readings)):
+        if await _insert_user(session, user_id, f"User_{user_id}", user_id in ADMIN_IDS):
+            activity.setdefault(today, {}).setdefault('new_users', 0)
+            activity[today]['new_users'] += 1
+            logger.info(f"Создан пользователь при сохранении замера: {user_id}")
+
+    session.add_all(readings)
+    await session.execute(daily_activity_upsert(), daily_activity_params(activity))
+    await session.execute(period_stats_upsert(), period_stats_params(readings_stats_deltas(readings)))
+    await session.execute(histogram_upsert(), histogram_params(readings_histogram_deltas(readings)))
+
+    # Общее количество записей — по статистике, без COUNT(*) по замерам
+    result = await session.execute(
+        select(UserPeriodStats.user_id, func.sum(UserPeriodStats.count))
+        .where(UserPeriodStats.user_id.in_(user_ids))
+        .group_by(UserPeriodStats.user_id)
+    )
+    return dict(result.all())
+
+
+async def _insert_user(session, vk_id: int, name: str, is_admin: bool) -> bool:
+    """Создать пользователя, если его ещё нет (без commit); True — создан"""
+    result = await session.execute(user_insert_missing(vk_id, name, is_admin))
+    if result.first() is None:
+        return False
+    user_cache.invalidate(vk_id)
+    return True
+
+
+async def save_glucose_reading(user_id: int, value: float, period: str):
+    """Сохранить показание глюкозы и обновить накопительную статистику в одной транзакции"""
+    async with AsyncSession() as session:
+        try:
+            reading = GlucoseReading(
+                user_id=user_id,
+                value=value,
+                period=period,
+                timestamp=datetime.now()
+            )
+            totals = await store_readings(session, [reading])
+            await session.commit()
+            logger.info(f"Сохранено показание: {value} для пользователя {user_id}")
+            invalidate_user_charts(user_id)
+            return reading, totals[user_id]
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Ошибка сохранения: {e}")
+            raise
+
+
+# ============= АДМИНИСТРИРОВАНИЕ =============
+async def get_admin_summary():
+    """Количество клиентов, замеров, замеров и активных клиентов за сегодня (по daily_activity)"""
+    async with AsyncSession() as session:
+        total_readings, total_users = (await session.execute(activity_totals_query())).one()
+        today = await session.get(DailyActivity, datetime.now().date())
+        today_readings = today.readings if today else 0
+        today_active = today.active_users if today else 0
+        return total_users, total_readings, today_readings, today_active
+
+
+async def get_daily_activity(days: int = 30):
+    """Дневная активность за последние days дней"""
+    async with AsyncSession() as session:
+        return (await session.scalars(daily_activity_query(days))).all()
+
+
+async def get_clients_overview(limit: int = None, offset: int = 0):
+    """Клиенты (без администраторов) с количеством замеров и средним, по имени"""
+    query = clients_overview_query().order_by(User.name, User.vk_id).offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+
+    async with AsyncSession() as session:
+        result = await session.execute(query)
+        return result.all()
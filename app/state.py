@@ -0,0 +1,102 @@
+"""
+Хранилища состояний диалога (какой период выбран и ждём ли ввод значения)
+"""
+import logging
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+from cache import TTLCache, MISSING
+from database import AsyncSession, ConversationState
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(ABC):
+    """Асинхронный интерфейс хранилища состояний"""
+
+    @abstractmethod
+    async def get(self, vk_id: int):
+        """Состояние пользователя или None"""
+
+    @abstractmethod
+    async def set(self, vk_id: int, state: dict):
+        """Сохранить состояние (истекает через TTL хранилища)"""
+
+    @abstractmethod
+    async def delete(self, vk_id: int):
+        """Удалить состояние"""
+
+
+class MemoryStateStore(StateStore):
+    """Состояния в памяти процесса: TTL и ограничение размера (вытесняются самые старые)"""
+
+    def __init__(self, ttl: float, max_size: int):
+        self._states = TTLCache('conversation_state', max_size, ttl)
+
+    async def get(self, vk_id: int):
+        state = self._states.get(vk_id)
+        return None if state is MISSING else state
+
+    async def set(self, vk_id: int, state: dict):
+        self._states.set(vk_id, dict(state))
+
+    async def delete(self, vk_id: int):
+        self._states.invalidate(vk_id)
+
+
+class DatabaseStateStore(StateStore):
+    """
+    Состояния в таблице conversation_states: переживают перезапуск
+    и общие для всех процессов бота, работающих с одной базой
+    """
+
+    # Как часто удалять истёкшие состояния (секунды)
+    PURGE_INTERVAL = 300
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._next_purge = 0.0
+
+    async def get(self, vk_id: int):
+        async with AsyncSession() as session:
+            row = await session.get(ConversationState, vk_id)
+            if row is None or row.expires_at <= datetime.now():
+                return None
+            return row.data
+
+    async def set(self, vk_id: int, state: dict):
+        expires_at = datetime.now() + timedelta(seconds=self.ttl)
+        async with AsyncSession() as session:
+            await session.merge(ConversationState(vk_id=vk_id, data=dict(state), expires_at=expires_at))
+            await session.commit()
+        await self._purge_expired()
+
+    async def delete(self, vk_id: int):
+        async with AsyncSession() as session:
+            await session.execute(delete(ConversationState).where(ConversationState.vk_id == vk_id))
+            await session.commit()
+
+    async def _purge_expired(self):
+        if time.monotonic() < self._next_purge:
+            return
+        self._next_purge = time.monotonic() + self.PURGE_INTERVAL
+
+        async with AsyncSession() as session:
+            result = await session.execute(
+                delete(ConversationState).where(ConversationState.expires_at <= datetime.now())
+            )
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"Удалено истёкших состояний: {result.rowcount}")
+
+
+def create_state_store(backend: str, ttl: float, max_size: int) -> StateStore:
+    """Хранилище состояний по имени бэкенда из конфигурации"""
+    if backend == 'memory':
+        return MemoryStateStore(ttl, max_size)
+    if backend == 'database':
+        return DatabaseStateStore(ttl)
+    raise ValueError(f"Неизвестное хранилище состояний: {backend}")
@@ -0,0 +1,130 @@
+"""
+Отложенная запись замеров глюкозы (write-behind)
+Замеры, пришедшие в течение короткого окна, сохраняются одной транзакцией —
+один fsync SQLite на пачку вместо одного на каждый замер
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from database import AsyncSession, GlucoseReading
+from repository import store_readings
+from cache import invalidate_user_charts
+from metrics import Counter, Histogram
+from instrumentation import background_task
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = Histogram(
+    'write_batch_size', 'Замеров в одной транзакции отложенной записи',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+WRITE_FLUSH_SECONDS = Histogram('write_flush_seconds', 'Время записи пачки замеров')
+WRITE_ERRORS = Counter('write_errors_total', 'Пачки замеров, которые не удалось сохранить')
+
+
+class ReadingWriter:
+    """Очередь замеров с групповым commit"""
+
+    def __init__(self, window: float = 0.05, max_batch: int = 500):
+        """
+        :param window: сколько секунд собирать замеры после первого в пачке
+        :param max_batch: максимум замеров в одной транзакции
+        """
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._task = None
+        self._closed = False
+
+    def _ensure_started(self):
+        # Очередь и фоновая задача создаются в работающем event loop бота
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = background_task(self._run())
+
+    async def save(self, user_id: int, value: float, period: str):
+        """
+        Поставить замер в очередь и дождаться commit его пачки
+        :return: (замер, общее количество записей пользователя с учётом этого замера)
+        """
+        if self._closed:
+            raise RuntimeError("Очередь записи замеров закрыта")
+        self._ensure_started()
+
+        reading = GlucoseReading(user_id=user_id, value=value, period=period, timestamp=datetime.now())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((reading, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = await self._collect(batch)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _collect(self, batch) -> bool:
+        """Добрать замеры до конца окна или до max_batch; True — получен сигнал остановки"""
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get_nowait() if timeout <= 0 else \
+                    await asyncio.wait_for(self._queue.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _flush(self, batch):
+        readings = [reading for reading, _ in batch]
+        started = time.perf_counter()
+        try:
+            async with AsyncSession() as session:
+                try:
+                    totals = await store_readings(session, readings)
+                    await session.commit()
+                except Exception:
+                    await session.rollback()
+                    raise
+        except Exception as e:
+            WRITE_ERRORS.inc()
+            logger.error(f"Ошибка сохранения пачки из {len(batch)} замеров: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            WRITE_FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+        WRITE_BATCH_SIZE.observe(len(batch))
+        logger.info(f"Сохранено замеров одной транзакцией: {len(batch)}")
+
+        # Итог после пачки известен по каждому пользователю; для более ранних замеров
+        # того же пользователя вычитаем замеры, пришедшие после них
+        remaining = dict(totals)
+        for reading, future in reversed(batch):
+            total = remaining[reading.user_id]
+            remaining[reading.user_id] = total - 1
+            if not future.done():
+                future.set_result((reading, total))
+
+        for user_id in totals:
+            invalidate_user_charts(user_id)
+
+    async def close(self):
+        """Записать всё, что осталось в очереди, и остановить фоновую задачу"""
+        self._closed = True
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None